@@ -0,0 +1,190 @@
+"""
+Bottleneck feature cache for training new classifier heads.
+
+When only the head is trained, the frozen base network gives the same output
+for an image every epoch. This module runs the base network once per image,
+stores the pooled features as float16 in a memory-mapped file, and looks
+them up by image path and content hash, so later runs only compute features
+for new or changed images. The head is then trained on the stored features:
+
+    base_model = MobileNet(input_shape=(224, 224, 3), include_top=False,
+                           weights="imagenet", pooling=None)
+    cache = FeatureCache("features/mobilenet", "mobilenet-224")
+    X_train, y_train = folder_features(base_model, "snacks/train", cache,
+                                       preprocess_input, 224, 224)
+
+    head = Sequential([Dense(20, activation="softmax", input_shape=X_train.shape[1:])])
+    head.compile(...)
+    head.fit(X_train, y_train, ...)
+    model = attach_head(base_model, head)
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from snacks_inference import IMAGE_EXTENSIONS, SnackClassifier, labels as snack_labels
+
+
+INDEX_FILENAME = "index.json"
+FEATURES_FILENAME = "features.f16"
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureCache(object):
+    """
+    A folder holding one row of float16 features per image. The rows live in
+    a single file that only ever gets appended to, and index.json maps every
+    image path to its content hash and row. model_name identifies the base
+    network and its input size; opening a cache made for another model
+    raises an error instead of mixing up features.
+    """
+    def __init__(self, path, model_name):
+        self.path = path
+        self.model_name = model_name
+        self.index_path = os.path.join(path, INDEX_FILENAME)
+        self.features_path = os.path.join(path, FEATURES_FILENAME)
+        self.entries = {}
+        self.feature_size = None
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index["model_name"] != model_name:
+                raise ValueError("The feature cache at %s was made for %s, not %s"
+                                 % (path, index["model_name"], model_name))
+            self.entries = index["entries"]
+            self.feature_size = index["feature_size"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def features(self):
+        """Returns all stored rows as a read-only memory-mapped array."""
+        if not self.entries:
+            return np.zeros((0, self.feature_size or 0), dtype=np.float16)
+        num_rows = os.path.getsize(self.features_path) // (2 * self.feature_size)
+        return np.memmap(self.features_path, dtype=np.float16, mode="r",
+                         shape=(num_rows, self.feature_size))
+
+    def lookup(self, paths, hashes):
+        """
+        Returns the row of every image, or -1 where the image isn't stored or
+        its content has changed.
+        """
+        rows = np.full(len(paths), -1, dtype=np.int64)
+        for i, (path, sha1) in enumerate(zip(paths, hashes)):
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == sha1:
+                rows[i] = entry[1]
+        return rows
+
+    def append(self, paths, hashes, features):
+        """
+        Stores the features of the given images and returns their rows. The
+        new rows are only found by later runs after save_index is called.
+        """
+        features = np.asarray(features, dtype=np.float16).reshape(len(paths), -1)
+        if self.feature_size is None:
+            self.feature_size = features.shape[1]
+        elif features.shape[1] != self.feature_size:
+            raise ValueError("Expected %d features per image, got %d"
+                             % (self.feature_size, features.shape[1]))
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.features_path, "ab") as f:
+            start = f.tell() // (2 * self.feature_size)
+            f.write(features.tobytes())
+        rows = np.arange(start, start + len(paths))
+        for path, sha1, row in zip(paths, hashes, rows):
+            self.entries[path] = [sha1, int(row)]
+        return rows
+
+    def save_index(self):
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump({"model_name": self.model_name, "feature_size": self.feature_size,
+                       "entries": self.entries}, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+
+def extract_features(base_model, paths, cache, preprocess_input, image_height, image_width,
+                     batch_size=64, num_workers=None, verbose=True):
+    """
+    Returns a float16 array with the pooled base_model features of every
+    image in paths, running base_model only on the images that aren't in the
+    cache yet. Outputs with spatial dimensions, as from MobileNet with
+    pooling=None, are averaged over them like GlobalAveragePooling2D does.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers or min(8, os.cpu_count() or 1)) as executor:
+        hashes = list(executor.map(file_hash, paths))
+    rows = cache.lookup(paths, hashes)
+
+    missing = np.flatnonzero(rows < 0)
+    if len(missing) > 0:
+        if verbose:
+            print("Computing features for %d of %d images" % (len(missing), len(paths)))
+        classifier = SnackClassifier(base_model, preprocess_input, image_height, image_width,
+                                     batch_size=batch_size, num_workers=num_workers)
+        missing_paths = [paths[i] for i in missing]
+        done = 0
+        for batch_index, (batch_paths, outputs) in enumerate(
+                classifier.predict_batches(missing_paths)):
+            if outputs.ndim == 4:
+                outputs = outputs.mean(axis=(1, 2))
+            batch = missing[done:done + len(batch_paths)]
+            rows[batch] = cache.append(batch_paths, [hashes[i] for i in batch], outputs)
+            done += len(batch_paths)
+
+            # Save the index now and then, so an interrupted run keeps most
+            # of its work.
+            if batch_index % 50 == 49:
+                cache.save_index()
+        cache.save_index()
+
+    return np.asarray(cache.features()[rows])
+
+
+def folder_features(base_model, folder, cache, preprocess_input, image_height, image_width,
+                    labels=None, batch_size=64, num_workers=None, verbose=True):
+    """
+    Returns the features and class indices of all images in a folder with one
+    subfolder per class, such as snacks/train, in the same order that
+    ImageDataGenerator.flow_from_directory uses.
+    """
+    labels = labels or snack_labels
+    paths, targets = [], []
+    for i, label in enumerate(labels):
+        class_dir = os.path.join(folder, label)
+        if not os.path.isdir(class_dir):
+            continue
+        for filename in sorted(os.listdir(class_dir)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            paths.append(os.path.join(class_dir, filename))
+            targets.append(i)
+    features = extract_features(base_model, paths, cache, preprocess_input,
+                                image_height, image_width, batch_size, num_workers, verbose)
+    return features, np.array(targets)
+
+
+def attach_head(base_model, head):
+    """
+    Puts a head trained on cached features on top of base_model, adding the
+    global average pooling that extract_features did, so the result can be
+    used on images directly or converted to Core ML.
+    """
+    from keras.layers import GlobalAveragePooling2D
+    from keras.models import Model
+    x = base_model.output
+    if len(base_model.output_shape) == 4:
+        x = GlobalAveragePooling2D()(x)
+    return Model(base_model.input, head(x))
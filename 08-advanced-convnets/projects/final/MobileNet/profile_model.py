@@ -0,0 +1,187 @@
+"""
+Per-layer profile of a Keras model: parameters, multiply-accumulates,
+activation memory and measured CPU time for each batch size.
+
+    python profile_model.py --mobilenet --batch-sizes 1 8 32 --output mobilenet.csv
+    python profile_model.py --model checkpoints/multisnacks-0.7162-0.8419.hdf5 \
+        --output multisnacks.json
+
+The table is written as CSV or JSON depending on the extension of --output,
+and the layers that take the most time are printed. To compare variants of
+the model, such as other values of alpha, build them and pass them to
+profile_model().
+"""
+import argparse
+import csv
+import json
+import time
+
+import numpy as np
+from keras import backend as K
+from keras.engine import InputLayer
+from keras.layers import Conv2D, Dense, DepthwiseConv2D, SeparableConv2D
+from keras.models import Model
+
+
+def as_list(x):
+    return x if isinstance(x, list) else [x]
+
+
+def network_node_index(model, layer):
+    """
+    Returns which of the layer's nodes belongs to model, since a layer that
+    is shared, or a model used as a layer, has several.
+    """
+    network_nodes = getattr(model, "_network_nodes", None)
+    if network_nodes:
+        for node_index in range(len(layer._inbound_nodes)):
+            if "%s_ib-%d" % (layer.name, node_index) in network_nodes:
+                return node_index
+    return 0
+
+
+def count_macs(layer, input_shape, output_shape):
+    """
+    Returns the number of multiply-accumulates per image for convolution and
+    Dense layers. Other layers are counted as 0; their cost is memory bound
+    and shows up in the measured time instead.
+    """
+    output_size = np.prod(output_shape[1:-1], dtype=np.int64)
+    if isinstance(layer, SeparableConv2D):
+        kh, kw = layer.kernel_size
+        in_channels = input_shape[-1]
+        depthwise = kh * kw * in_channels * layer.depth_multiplier * output_size
+        return int(depthwise + in_channels * layer.depth_multiplier * layer.filters * output_size)
+    if isinstance(layer, DepthwiseConv2D):
+        kh, kw = layer.kernel_size
+        return int(kh * kw * input_shape[-1] * layer.depth_multiplier * output_size)
+    if isinstance(layer, Conv2D):
+        kh, kw = layer.kernel_size
+        return int(kh * kw * input_shape[-1] * layer.filters * output_size)
+    if isinstance(layer, Dense):
+        return int(input_shape[-1] * layer.units * np.prod(output_shape[1:-1], dtype=np.int64))
+    return 0
+
+
+def median_time(fn, args, repeats):
+    fn(args)
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn(args)
+        times.append(time.perf_counter() - start_time)
+    return float(np.median(times))
+
+
+def profile_layers(model, inputs, batch_sizes, repeats, prefix=""):
+    """
+    Profiles every layer of model given a batch of inputs for it, the size
+    of the largest batch size. Each layer is timed on its own, by feeding it
+    the activations that the layers before it produce for these inputs.
+    Models used as layers also get a row for each of their own layers.
+    """
+    layers = [layer for layer in model.layers if not isinstance(layer, InputLayer)]
+    nodes = [network_node_index(model, layer) for layer in layers]
+    layer_inputs = [as_list(layer.get_input_at(node)) for layer, node in zip(layers, nodes)]
+
+    # One pass through the whole model computes the inputs of every layer.
+    flat_inputs = [tensor for tensors in layer_inputs for tensor in tensors]
+    compute_inputs = K.function(model.inputs + [K.learning_phase()], flat_inputs)
+    flat_values = compute_inputs(inputs + [0])
+
+    rows = []
+    position = 0
+    for layer, node, tensors in zip(layers, nodes, layer_inputs):
+        values = flat_values[position:position + len(tensors)]
+        position += len(tensors)
+
+        input_shape = as_list(layer.get_input_shape_at(node))[0]
+        output_shapes = as_list(layer.get_output_shape_at(node))
+        activations = sum(int(np.prod(shape[1:], dtype=np.int64)) for shape in output_shapes)
+        row = {"layer": prefix + layer.name,
+               "type": layer.__class__.__name__,
+               "output_shape": "x".join(str(d) for d in output_shapes[0][1:]),
+               "params": layer.count_params(),
+               "macs": count_macs(layer, input_shape, output_shapes[0]),
+               "activation_bytes": activations * 4}
+
+        run_layer = K.function(tensors + [K.learning_phase()],
+                               as_list(layer.get_output_at(node)))
+        for batch_size in batch_sizes:
+            args = [value[:batch_size] for value in values] + [0]
+            row["ms_batch_%d" % batch_size] = median_time(run_layer, args, repeats) * 1000
+        rows.append(row)
+
+        if isinstance(layer, Model):
+            rows.extend(profile_layers(layer, values, batch_sizes, repeats,
+                                       prefix + layer.name + "/"))
+    return rows
+
+
+def profile_model(model, batch_sizes=(1, 8, 32), repeats=10, seed=0):
+    """
+    Returns a list with a row (a dict) per layer: its parameter count,
+    multiply-accumulates per image, activation memory per image in bytes
+    (float32), and the median time in milliseconds to run it on a batch, for
+    each batch size. Random inputs are used, since the time doesn't depend
+    on the values.
+    """
+    batch_sizes = sorted(batch_sizes)
+    rng = np.random.RandomState(seed)
+    inputs = [rng.standard_normal((batch_sizes[-1],) + tuple(shape[1:])).astype(np.float32)
+              for shape in as_list(model.input_shape)]
+    return profile_layers(model, inputs, batch_sizes, repeats)
+
+
+def write_table(rows, path):
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(rows, f, indent=1)
+    else:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def print_summary(rows, top=10):
+    time_key = [key for key in rows[0] if key.startswith("ms_batch_")][-1]
+    # Rows of nested layers would count their time twice.
+    outer_rows = [row for row in rows if "/" not in row["layer"]]
+    total_time = sum(row[time_key] for row in outer_rows)
+    print("Total: %d params, %.1f M MACs per image, %.2f ms (%s)"
+          % (sum(row["params"] for row in outer_rows),
+             sum(row["macs"] for row in rows) / 1e6, total_time, time_key))
+    print("%-32s %-20s %12s %10s %7s" % ("layer", "type", "MACs", "ms", "time"))
+    for row in sorted(rows, key=lambda row: -row[time_key])[:top]:
+        print("%-32s %-20s %12d %10.3f %6.1f%%" % (row["layer"], row["type"], row["macs"],
+                                                  row[time_key],
+                                                  100 * row[time_key] / total_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the layers of a Keras model.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--model", help="model saved as .hdf5")
+    source.add_argument("--mobilenet", action="store_true",
+                        help="profile MobileNet as built by keras.applications")
+    parser.add_argument("--input-size", type=int, default=224, help="MobileNet input size")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--output", default="profile.csv", help=".csv or .json file")
+    args = parser.parse_args()
+
+    if args.mobilenet:
+        from keras.applications.mobilenet import MobileNet
+        model = MobileNet(weights=None, input_shape=(args.input_size, args.input_size, 3))
+    else:
+        from keras.models import load_model
+        model = load_model(args.model, compile=False)
+
+    rows = profile_model(model, args.batch_sizes, args.repeats)
+    write_table(rows, args.output)
+    print_summary(rows)
+
+
+if __name__ == "__main__":
+    main()
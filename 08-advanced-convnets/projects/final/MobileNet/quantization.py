@@ -0,0 +1,284 @@
+"""
+Post-training weight quantization for the MobileNet snack classifier.
+
+The kernels of the Dense layers in the classifier head are stored as int8
+with one scale per output channel, or as float16. Keras has no int8 kernels,
+so the weights are turned back into float32 when they are put into a model:
+quantization makes the stored model smaller and shows how much accuracy the
+smaller weights cost, but it doesn't make predict() faster. The report
+measures latency anyway, to confirm that.
+
+    python quantization.py \
+        --weights checkpoints/multisnacks-0.7162-0.8419.hdf5 \
+        --calibration snacks/val --test snacks/test --output mobilenet-int8.npz
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from keras.layers import Dense
+
+
+def iter_layers(model):
+    """Yields the layers of model, including those inside nested models."""
+    for layer in model.layers:
+        if hasattr(layer, "layers"):
+            for inner in iter_layers(layer):
+                yield inner
+        else:
+            yield layer
+
+
+def find_layer(model, name):
+    for layer in iter_layers(model):
+        if layer.name == name:
+            return layer
+    raise ValueError("No layer named %s" % name)
+
+
+def default_layer_names(model):
+    """Returns the names of all Dense layers, such as those of the head."""
+    return [layer.name for layer in iter_layers(model) if isinstance(layer, Dense)]
+
+
+def quantize_kernel(kernel, mode="int8", clip_percentile=100.0):
+    """
+    Quantizes a Conv2D or Dense kernel, whose last axis is the output
+    channels. With mode="int8", each output channel is scaled so that the
+    clip_percentile percentile of its absolute weights maps to 127; larger
+    weights are clipped. Returns a dict with the quantized kernel and, for
+    int8, the per-channel scales.
+    """
+    if mode == "float16":
+        return {"kernel": kernel.astype(np.float16)}
+    if mode != "int8":
+        raise ValueError("Unknown quantization mode: %s" % mode)
+
+    abs_weights = np.abs(kernel).reshape(-1, kernel.shape[-1])
+    clip = np.percentile(abs_weights, clip_percentile, axis=0)
+    scale = np.where(clip > 0, clip / 127., 1.).astype(np.float32)
+    q = np.clip(np.round(kernel / scale), -127, 127).astype(np.int8)
+    return {"kernel": q, "scale": scale}
+
+
+def dequantize_kernel(quantized):
+    kernel = quantized["kernel"].astype(np.float32)
+    if "scale" in quantized:
+        kernel *= quantized["scale"]
+    return kernel
+
+
+def quantize_model(model, mode="int8", layer_names=None, clip_percentiles=None):
+    """
+    Quantizes the kernels of the given layers of model, by default those of
+    default_layer_names. clip_percentiles, as returned by calibrate, gives the
+    clipping percentile per layer; layers without one aren't clipped.
+    Returns a dict from layer name to quantized kernel. The model itself is
+    not changed; use apply_quantized for that.
+    """
+    if layer_names is None:
+        layer_names = default_layer_names(model)
+    clip_percentiles = clip_percentiles or {}
+    return {name: quantize_kernel(find_layer(model, name).get_weights()[0], mode,
+                                  clip_percentiles.get(name, 100.0))
+            for name in layer_names}
+
+
+def apply_quantized(model, quantized):
+    """Replaces the kernels of model by the dequantized kernels."""
+    for name, q in quantized.items():
+        layer = find_layer(model, name)
+        weights = layer.get_weights()
+        layer.set_weights([dequantize_kernel(q)] + weights[1:])
+
+
+def calibrate(model, images, layer_names=None, candidates=(100.0, 99.99, 99.9),
+              batch_size=32):
+    """
+    Picks the int8 clipping percentile for every layer using a sample of
+    preprocessed images. Layer by layer, each candidate is tried with the
+    layers before it already quantized, and the one whose predictions stay
+    closest (in mean squared error) to the float model's is kept. This takes
+    one predict over the images per layer and candidate, so a few dozen
+    images are enough. Returns a dict from layer name to percentile; the
+    model's weights are restored afterwards.
+    """
+    if layer_names is None:
+        layer_names = default_layer_names(model)
+    float_weights = model.get_weights()
+    reference = model.predict(images, batch_size=batch_size)
+
+    choices = {}
+    try:
+        for name in layer_names:
+            layer = find_layer(model, name)
+            weights = layer.get_weights()
+            best_error, best_kernel = None, None
+            for percentile in candidates:
+                kernel = dequantize_kernel(quantize_kernel(weights[0], "int8", percentile))
+                layer.set_weights([kernel] + weights[1:])
+                predictions = model.predict(images, batch_size=batch_size)
+                error = np.mean((predictions - reference) ** 2)
+                if best_error is None or error < best_error:
+                    best_error, best_kernel = error, kernel
+                    choices[name] = percentile
+            layer.set_weights([best_kernel] + weights[1:])
+    finally:
+        model.set_weights(float_weights)
+    return choices
+
+
+def quantized_arrays(model, quantized):
+    """
+    Returns the arrays that save_quantized writes: every weight of every
+    layer, with the quantized kernels and their scales in place of the
+    float kernels.
+    """
+    arrays = {}
+    for layer in iter_layers(model):
+        for i, weight in enumerate(layer.get_weights()):
+            arrays["%s::%d" % (layer.name, i)] = weight
+        if layer.name in quantized:
+            q = quantized[layer.name]
+            arrays["%s::0" % layer.name] = q["kernel"]
+            if "scale" in q:
+                arrays["%s::0::scale" % layer.name] = q["scale"]
+    return arrays
+
+
+def save_quantized(model, quantized, path):
+    np.savez(path, **quantized_arrays(model, quantized))
+
+
+def load_quantized(model, path):
+    """
+    Loads weights saved by save_quantized into a model with the same
+    architecture, dequantizing the quantized kernels.
+    """
+    with np.load(path) as arrays:
+        for layer in iter_layers(model):
+            count = len(layer.get_weights())
+            if count == 0:
+                continue
+            weights = []
+            for i in range(count):
+                key = "%s::%d" % (layer.name, i)
+                q = {"kernel": arrays[key]}
+                if key + "::scale" in arrays.files:
+                    q["scale"] = arrays[key + "::scale"]
+                weights.append(dequantize_kernel(q))
+            layer.set_weights(weights)
+
+
+def load_sample(folder, preprocess_input, image_height, image_width,
+                count=None, labels=None, seed=0):
+    """
+    Loads count randomly chosen images, or all of them, from a folder with
+    one subfolder per class, such as snacks/val. Returns the preprocessed
+    images and their class indices into labels.
+    """
+    from keras.preprocessing import image
+    from snacks_inference import labels as snack_labels
+    labels = labels or snack_labels
+
+    samples = [(os.path.join(folder, label, filename), i)
+               for i, label in enumerate(labels)
+               if os.path.isdir(os.path.join(folder, label))
+               for filename in sorted(os.listdir(os.path.join(folder, label)))]
+    if count is not None and count < len(samples):
+        chosen = np.random.RandomState(seed).choice(len(samples), count, replace=False)
+        samples = [samples[i] for i in sorted(chosen)]
+
+    X = np.empty((len(samples), image_height, image_width, 3), dtype=np.float32)
+    for i, (path, _) in enumerate(samples):
+        img = image.load_img(path, target_size=(image_height, image_width))
+        X[i] = image.img_to_array(img)
+    return preprocess_input(X), np.array([label for _, label in samples])
+
+
+def median_latency(model, images, batch_size, repeats=10):
+    batch = images[:batch_size]
+    model.predict(batch, batch_size=batch_size)
+    times = []
+    for _ in range(repeats):
+        start_time = time.time()
+        model.predict(batch, batch_size=batch_size)
+        times.append(time.time() - start_time)
+    return float(np.median(times)) * 1000
+
+
+def quantization_report(model, variants, images, labels=None, batch_size=32):
+    """
+    Compares the float model with each of the quantized variants, a dict from
+    name to the output of quantize_model, on preprocessed images. Returns a
+    list with a row per model: accuracy (if labels are given), how often the
+    top prediction matches the float model's, size of the saved weights in
+    bytes, and median milliseconds to predict one batch. The model's float
+    weights are restored afterwards.
+    """
+    float_weights = model.get_weights()
+    float_bytes = sum(w.nbytes for w in float_weights)
+    reference = None
+    rows = []
+    try:
+        for name, quantized in [("float32", None)] + list(variants.items()):
+            model.set_weights(float_weights)
+            if quantized is not None:
+                apply_quantized(model, quantized)
+            predicted = np.argmax(model.predict(images, batch_size=batch_size), axis=-1)
+            if reference is None:
+                reference = predicted
+
+            row = {"model": name,
+                   "agreement": float(np.mean(predicted == reference)),
+                   "bytes": float_bytes if quantized is None else
+                            sum(a.nbytes for a in quantized_arrays(model, quantized).values()),
+                   "latency_ms": median_latency(model, images, batch_size)}
+            if labels is not None:
+                row["accuracy"] = float(np.mean(predicted == labels))
+            rows.append(row)
+    finally:
+        model.set_weights(float_weights)
+    return rows
+
+
+def print_report(rows):
+    print("%-10s %9s %10s %12s %11s" % ("model", "accuracy", "agreement", "size (MB)", "latency ms"))
+    for row in rows:
+        accuracy = "%.4f" % row["accuracy"] if "accuracy" in row else "-"
+        print("%-10s %9s %10.4f %12.2f %11.1f" % (row["model"], accuracy, row["agreement"],
+                                                 row["bytes"] / 1e6, row["latency_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize a snack classifier's weights.")
+    parser.add_argument("--weights", required=True, help="checkpoint saved by the notebook")
+    parser.add_argument("--calibration", required=True, help="folder to draw calibration images from")
+    parser.add_argument("--calibration-count", type=int, default=64)
+    parser.add_argument("--test", required=True, help="folder with the images for the report")
+    parser.add_argument("--test-count", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", help="where to save the int8 weights (.npz)")
+    args = parser.parse_args()
+
+    from snacks_inference import load_mobilenet_classifier
+    classifier = load_mobilenet_classifier(args.weights, args.batch_size)
+    model = classifier.model
+    sample_args = (classifier.preprocess_input, classifier.image_height, classifier.image_width)
+
+    calibration_images, _ = load_sample(args.calibration, *sample_args,
+                                        count=args.calibration_count)
+    clip_percentiles = calibrate(model, calibration_images, batch_size=args.batch_size)
+    variants = {"int8": quantize_model(model, "int8", clip_percentiles=clip_percentiles),
+                "float16": quantize_model(model, "float16")}
+
+    test_images, test_labels = load_sample(args.test, *sample_args, count=args.test_count)
+    print_report(quantization_report(model, variants, test_images, test_labels,
+                                     args.batch_size))
+    if args.output:
+        save_quantized(model, variants["int8"], args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Batched CPU inference for the MobileNet snack classifier.
+
+    python snacks_inference.py \
+        --weights checkpoints/multisnacks-0.7162-0.8419.hdf5 snacks/test
+
+prints the top predictions for every image as CSV, and the throughput in
+images per second when done. The SqueezeNet folder has the same script for
+the SqueezeNet classifier.
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from keras.preprocessing import image
+
+
+labels = ["apple", "banana", "cake", "candy", "carrot", "cookie",
+          "doughnut", "grape", "hot dog", "ice cream", "juice",
+          "muffin", "orange", "pineapple", "popcorn", "pretzel",
+          "salad", "strawberry", "waffle", "watermelon"]
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def image_paths(folder):
+    """Returns the paths of all images in folder and its subfolders, sorted."""
+    paths = []
+    for root, _, filenames in os.walk(folder):
+        paths.extend(os.path.join(root, filename) for filename in filenames
+                     if filename.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+class SnackClassifier(object):
+    """
+    Runs a Keras classifier over many images. Images are decoded, resized
+    and preprocessed on num_workers threads, overlapping with the prediction
+    of the previous batch, and always go through the model in batches of
+    batch_size, padding the last one, so every predict call has the same
+    shape. The threads write the images into two float32 batches that are
+    used in turn, one being filled while the other is predicted. The model is run
+    once on a blank batch when the classifier is created, so the first real
+    batch doesn't pay for graph setup.
+    """
+    def __init__(self, model, preprocess_input, image_height, image_width,
+                 labels=labels, batch_size=32, num_workers=None):
+        self.model = model
+        self.preprocess_input = preprocess_input
+        self.image_height = image_height
+        self.image_width = image_width
+        self.labels = labels
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=num_workers or min(8, os.cpu_count() or 1))
+        self.images_done = 0
+        self.seconds = 0.0
+
+        self.model.predict(np.zeros((batch_size, image_height, image_width, 3), dtype=np.float32),
+                           batch_size=batch_size)
+
+    def load_image(self, path, X, i):
+        """Decodes and preprocesses the image at path into X[i]."""
+        img = image.load_img(path, target_size=(self.image_height, self.image_width))
+        X[i] = self.preprocess_input(image.img_to_array(img))
+
+    def predict_batches(self, paths):
+        """
+        Yields (paths, probabilities) for every batch of the paths, which may
+        be any iterable, such as a generator that is still receiving images.
+        """
+        X_buffers = np.zeros((2, self.batch_size, self.image_height, self.image_width, 3),
+                             dtype=np.float32)
+
+        def submit(batch_paths, X):
+            return batch_paths, X, [self.executor.submit(self.load_image, path, X, i)
+                                    for i, path in enumerate(batch_paths)]
+
+        def batches():
+            batch_paths = []
+            for path in paths:
+                batch_paths.append(path)
+                if len(batch_paths) == self.batch_size:
+                    yield batch_paths
+                    batch_paths = []
+            if batch_paths:
+                yield batch_paths
+
+        pending = None
+        for batch_index, batch_paths in enumerate(batches()):
+            # Start loading this batch before waiting on the previous one,
+            # which uses the other buffer.
+            current, pending = pending, submit(batch_paths, X_buffers[batch_index % 2])
+            if current is not None:
+                yield self.predict_loaded(*current)
+        if pending is not None:
+            yield self.predict_loaded(*pending)
+
+    def predict_loaded(self, batch_paths, X, futures):
+        start_time = time.time()
+        for future in futures:
+            future.result()
+        X[len(futures):] = 0
+        probabilities = self.model.predict(X, batch_size=self.batch_size)
+        self.seconds += time.time() - start_time
+        self.images_done += len(futures)
+        return batch_paths, probabilities[:len(futures)]
+
+    def classify(self, paths, top_k=3):
+        """
+        Yields (path, [(label, probability), ...]) with the top_k most likely
+        labels for every image in paths.
+        """
+        for batch_paths, probabilities in self.predict_batches(paths):
+            top = np.argsort(-probabilities, axis=-1)[:, :top_k]
+            for path, indices, probs in zip(batch_paths, top, probabilities):
+                yield path, [(self.labels[i], float(probs[i])) for i in indices]
+
+    def images_per_second(self):
+        """
+        Images per second over all batches so far. The clock only runs
+        while batches are being waited for and predicted, so time spent by
+        the caller between batches isn't counted.
+        """
+        return self.images_done / self.seconds if self.seconds else 0.0
+
+
+def load_mobilenet_classifier(weights_path, batch_size=32, num_workers=None):
+    """Loads a MobileNet snack classifier saved by the MobileNet notebook."""
+    from keras.models import load_model
+    from keras.applications.mobilenet import preprocess_input
+    model = load_model(weights_path, compile=False)
+    return SnackClassifier(model, preprocess_input, 224, 224,
+                           batch_size=batch_size, num_workers=num_workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify snack images in batches.")
+    parser.add_argument("images", nargs="?",
+                        help="folder with images; without it, paths are read from stdin")
+    parser.add_argument("--weights", required=True, help="checkpoint saved by the notebook")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    classifier = load_mobilenet_classifier(args.weights, args.batch_size, args.workers)
+
+    if args.images:
+        paths = image_paths(args.images)
+    else:
+        paths = (line.strip() for line in sys.stdin if line.strip())
+
+    writer = csv.writer(sys.stdout)
+    for path, top in classifier.classify(paths, args.top_k):
+        writer.writerow([path] + ["%s:%.4f" % (label, prob) for label, prob in top])
+    print("%d images, %.1f images/sec" % (classifier.images_done,
+                                           classifier.images_per_second()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
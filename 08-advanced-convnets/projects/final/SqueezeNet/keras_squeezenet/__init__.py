@@ -1,2 +1,10 @@
-from keras_squeezenet.squeezenet import SqueezeNet
 from keras_squeezenet.version import __version__
+
+
+# SqueezeNet is imported on first use, so importing the package doesn't
+# load Keras until a model is actually needed.
+def __getattr__(name):
+    if name == 'SqueezeNet':
+        from keras_squeezenet.squeezenet import SqueezeNet
+        return SqueezeNet
+    raise AttributeError("module 'keras_squeezenet' has no attribute '%s'" % name)
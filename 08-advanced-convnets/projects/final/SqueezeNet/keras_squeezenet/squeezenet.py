@@ -1,11 +1,15 @@
-from keras_applications.imagenet_utils import _obtain_input_shape
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from keras_squeezenet.version import __version__
+
 from keras import backend as K
-from keras.layers import Input, Convolution2D, MaxPooling2D, Activation, concatenate, Dropout, warnings
+from keras.layers import Input, Convolution2D, MaxPooling2D, Activation, concatenate, Dropout
 from keras.layers import GlobalAveragePooling2D, GlobalMaxPooling2D
 from keras.models import Model
-from keras.engine.topology import get_source_inputs
-from keras.utils import get_file
-from keras.utils import layer_utils
 
 
 sq1x1 = "squeeze1x1"
@@ -16,6 +20,151 @@ relu = "relu_"
 WEIGHTS_PATH = "https://github.com/rcmalli/keras-squeezenet/releases/download/v1.0/squeezenet_weights_tf_dim_ordering_tf_kernels.h5"
 WEIGHTS_PATH_NO_TOP = "https://github.com/rcmalli/keras-squeezenet/releases/download/v1.0/squeezenet_weights_tf_dim_ordering_tf_kernels_notop.h5"
 
+# Local cache of weight files, stored under their SHA-256, and of pre-built
+# models. Set KERAS_SQUEEZENET_OFFLINE=1 to never download anything.
+CACHE_DIR = os.environ.get('KERAS_SQUEEZENET_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.keras', 'squeezenet'))
+OFFLINE = os.environ.get('KERAS_SQUEEZENET_OFFLINE', '') not in ('', '0')
+INDEX_DIRNAME = 'index'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def replace_atomically(path, write):
+    """Calls write with the path of a new temporary file next to path, then
+    moves that file to path. Every writer gets its own temporary file, so
+    processes filling the cache at the same time never see each other's
+    half-written files.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=os.path.splitext(path)[1] + '.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def index_entry_path(cache_dir, fname):
+    return os.path.join(cache_dir, INDEX_DIRNAME, fname + '.json')
+
+
+def read_cache_entry(cache_dir, fname):
+    try:
+        with open(index_entry_path(cache_dir, fname)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def add_weights_to_cache(path, fname, cache_dir=None, move=False):
+    """Copies the weights file at path into the cache as fname, e.g. to set up
+    a machine without internet access, or moves it there with move=True.
+    Returns the path of the cached copy. Each fname has its own small index
+    file, so processes adding different files don't overwrite each other's
+    entries.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    sha256 = file_sha256(path)
+    cached_path = os.path.join(cache_dir, sha256 + '.h5')
+    if os.path.exists(cached_path) and file_sha256(cached_path) == sha256:
+        if move:
+            os.remove(path)
+    elif move:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.replace(path, cached_path)
+    else:
+        replace_atomically(cached_path, lambda tmp_path: shutil.copyfile(path, tmp_path))
+
+    def write_entry(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump({'sha256': sha256, 'size': os.path.getsize(cached_path)}, f)
+    replace_atomically(index_entry_path(cache_dir, fname), write_entry)
+    return cached_path
+
+
+def keras_cached_file(fname):
+    """Returns the path where keras.utils.get_file would have stored fname,
+    in ~/.keras/models or, if that wasn't writable, /tmp/.keras/models,
+    provided it holds complete Keras weights. Otherwise returns None.
+    """
+    for keras_dir in (os.path.join(os.path.expanduser('~'), '.keras'),
+                      os.path.join('/tmp', '.keras')):
+        path = os.path.join(keras_dir, 'models', fname)
+        if os.path.exists(path) and is_weights_file(path):
+            return path
+    return None
+
+
+def is_weights_file(path):
+    """Whether path is a readable HDF5 file with the layer list that Keras
+    writes, so an interrupted download doesn't get into the cache.
+    """
+    try:
+        import h5py
+        with h5py.File(path, 'r') as f:
+            if 'model_weights' in f:
+                return 'layer_names' in f['model_weights'].attrs
+            return 'layer_names' in f.attrs
+    except (IOError, OSError):
+        return False
+
+
+def download_to_cache(fname, origin, cache_dir):
+    """Downloads origin into a temporary file inside the cache and moves it
+    to its place there, so the weights are stored only once.
+    """
+    from urllib.request import urlretrieve
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.h5.tmp')
+    os.close(fd)
+    try:
+        print('Downloading data from', origin)
+        urlretrieve(origin, tmp_path)
+        if not is_weights_file(tmp_path):
+            raise IOError('The download from ' + origin + ' is not a Keras weights file.')
+        return add_weights_to_cache(tmp_path, fname, cache_dir, move=True)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def cached_weights_path(fname, origin, cache_dir=None, offline=None, verify=False):
+    """Returns the path of the cached weights file fname. Cached files are
+    named after their SHA-256; with verify=True the hash is checked again,
+    otherwise only the file size is. The first time, a copy that
+    keras.utils.get_file downloaded earlier is imported if there is one,
+    and otherwise the file is downloaded from origin unless offline.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    offline = OFFLINE if offline is None else offline
+
+    entry = read_cache_entry(cache_dir, fname)
+    if entry is not None:
+        path = os.path.join(cache_dir, entry['sha256'] + '.h5')
+        if (os.path.exists(path) and os.path.getsize(path) == entry['size'] and
+                (not verify or file_sha256(path) == entry['sha256'])):
+            return path
+
+    keras_path = keras_cached_file(fname)
+    if keras_path is not None:
+        return add_weights_to_cache(keras_path, fname, cache_dir)
+
+    if offline:
+        raise IOError('The weights file ' + fname + ' is not in the cache at ' + cache_dir +
+                      '. Run once with internet access, or add it with add_weights_to_cache().')
+    return download_to_cache(fname, origin, cache_dir)
+
 # Modular function for Fire Node
 
 def fire_module(x, fire_id, squeeze=16, expand=64):
@@ -44,8 +193,16 @@ def fire_module(x, fire_id, squeeze=16, expand=64):
 def SqueezeNet(include_top=True, weights='imagenet',
                input_tensor=None, input_shape=None,
                pooling=None,
-               classes=1000):
+               classes=1000,
+               prebuilt=False,
+               cache_dir=None,
+               offline=None):
     """Instantiates the SqueezeNet architecture.
+
+    The ImageNet weights are kept in a local cache, see cached_weights_path.
+    With prebuilt=True, the finished model with ImageNet weights is saved in
+    the cache the first time and later loaded from that single file instead
+    of being built again. This needs input_tensor to be None.
     """
         
     if weights not in {'imagenet', None}:
@@ -58,6 +215,29 @@ def SqueezeNet(include_top=True, weights='imagenet',
                          ' as true, `classes` should be 1000')
 
 
+    weights_path = None
+    if weights == 'imagenet':
+        if include_top:
+            weights_path = cached_weights_path('squeezenet_weights_tf_dim_ordering_tf_kernels.h5',
+                                               WEIGHTS_PATH, cache_dir, offline)
+        else:
+            weights_path = cached_weights_path('squeezenet_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                                               WEIGHTS_PATH_NO_TOP, cache_dir, offline)
+
+    prebuilt_path = None
+    if prebuilt and weights == 'imagenet' and input_tensor is None:
+        # The key covers everything the built model depends on; the weights
+        # are identified by their hash, which is the name of the cached file.
+        key = json.dumps([__version__, include_top, weights_path and os.path.basename(weights_path),
+                          input_shape and list(input_shape), pooling, classes,
+                          K.image_data_format()])
+        prebuilt_path = os.path.join(cache_dir or CACHE_DIR, 'models',
+                                     hashlib.sha256(key.encode('utf-8')).hexdigest() + '.h5')
+        if os.path.exists(prebuilt_path):
+            from keras.models import load_model
+            return load_model(prebuilt_path, compile=False)
+
+    from keras_applications.imagenet_utils import _obtain_input_shape
     input_shape = _obtain_input_shape(input_shape,
                                       default_size=227,
                                       min_size=48,
@@ -113,6 +293,7 @@ def SqueezeNet(include_top=True, weights='imagenet',
     # Ensure that the model takes into account
     # any potential predecessors of `input_tensor`.
     if input_tensor is not None:
+        from keras.engine.topology import get_source_inputs
         inputs = get_source_inputs(input_tensor)
     else:
         inputs = img_input
@@ -121,22 +302,15 @@ def SqueezeNet(include_top=True, weights='imagenet',
 
     # load weights
     if weights == 'imagenet':
-        if include_top:
-            weights_path = get_file('squeezenet_weights_tf_dim_ordering_tf_kernels.h5',
-                                    WEIGHTS_PATH,
-                                    cache_subdir='models')
-        else:
-            weights_path = get_file('squeezenet_weights_tf_dim_ordering_tf_kernels_notop.h5',
-                                    WEIGHTS_PATH_NO_TOP,
-                                    cache_subdir='models')
-            
         model.load_weights(weights_path)
         if K.backend() == 'theano':
+            from keras.utils import layer_utils
             layer_utils.convert_all_kernels_in_model(model)
 
         if K.image_data_format() == 'channels_first':
 
             if K.backend() == 'tensorflow':
+                import warnings
                 warnings.warn('You are using the TensorFlow backend, yet you '
                               'are using the Theano '
                               'image data format convention '
@@ -145,6 +319,10 @@ def SqueezeNet(include_top=True, weights='imagenet',
                               '`image_data_format="channels_last"` in '
                               'your Keras config '
                               'at ~/.keras/keras.json.')
+
+    if prebuilt_path is not None:
+        replace_atomically(prebuilt_path,
+                           lambda tmp_path: model.save(tmp_path, include_optimizer=False))
     return model
 
 
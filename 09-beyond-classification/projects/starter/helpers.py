@@ -1,6 +1,7 @@
-import os, sys, PIL
+import os, sys, json, threading, PIL
 import numpy as np
 import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
 
 import keras
 from keras.preprocessing import image
@@ -61,63 +62,179 @@ def plot_image(img, bounding_boxes, figsize=(10, 10)):
 
 
 class BoundingBoxGenerator(keras.utils.Sequence):
-    def __init__(self, df, image_dir, image_height, image_width, batch_size, shuffle):
-        self.df = df
+    """Generates batches of (images, [class indices, bounding boxes]) from
+    an annotations dataframe.
+    Images are decoded on num_workers threads. If cache_path is given, all
+    images are decoded and resized once into a uint8 .npy file, which later
+    epochs and runs read through a memory map instead of decoding JPEGs.
+
+    Batches are written into preallocated arrays, used in turn in the order
+    the batches are requested, whatever their index, so a returned batch
+    stays valid until num_buffers more batches have been requested. Pass
+    the max_queue_size and workers given to fit_generator, and num_buffers
+    defaults to enough buffers for all the batches that can be in flight.
+    Each buffer holds one batch of dtype: with 224x224 images and a batch
+    size of 32, that is about 19 MB as float32 or 5 MB as uint8, so with
+    the 19 buffers needed for workers=8 a generator takes about 370 MB, or
+    90 MB with uint8.
+
+    With dtype=np.float32 the images are normalized for MobileNet. With
+    dtype=np.uint8 the raw pixels are returned, which makes each batch four
+    times smaller; put normalization_layer() at the start of the model to
+    normalize them there.
+    If include_last_batch is True, the final, smaller batch of each epoch
+    is generated too instead of being dropped.
+    """
+    def __init__(self, df, image_dir, image_height, image_width, batch_size, shuffle,
+                 num_workers=None, cache_path=None, dtype=np.float32,
+                 include_last_batch=False, max_queue_size=10, workers=1, num_buffers=None):
         self.image_dir = image_dir
         self.image_height = image_height
         self.image_width = image_width
         self.batch_size = batch_size
         self.shuffle = shuffle
+        self.dtype = np.dtype(dtype)
+        self.include_last_batch = include_last_batch
+        self.num_workers = num_workers or min(8, os.cpu_count() or 1)
+        self.executor = None
+        self.executor_pid = None
+
+        # Convert the dataframe columns into NumPy arrays once, so that
+        # getting a batch doesn't need to look up rows in the dataframe.
+        self.image_paths = np.array([os.path.join(image_dir, folder, image_id + ".jpg")
+                                     for folder, image_id in zip(df["folder"], df["image_id"])])
+        self.class_indices = df["class_name"].map(label2index).values.astype(int)
+        self.bboxes = df[["x_min", "x_max", "y_min", "y_max"]].values.astype(float)
+
+        self.cache = None
+        if cache_path:
+            self.cache = self.open_cache(cache_path)
+
+        # The images are decoded straight into these buffers, which are
+        # then normalized in place if the output is float. fit_generator
+        # keeps up to max_queue_size batches queued, one waiting to be
+        # queued, and one being trained on; the workers term adds a margin
+        # for batches still being produced.
+        if num_buffers is None:
+            num_buffers = max_queue_size + workers + 1
+        self.X_buffers = np.empty((num_buffers, batch_size, image_height, image_width, 3),
+                                  dtype=self.dtype)
+
+        # fit_generator requests batches from several threads and in shuffled
+        # order, so the buffers are handed out by a shared counter rather than
+        # by batch index.
+        self.next_buffer = 0
+        self.buffer_lock = threading.Lock()
+
         self.on_epoch_end()
 
     def __len__(self):
-        return len(self.df) // self.batch_size
+        if self.include_last_batch:
+            return (len(self.image_paths) + self.batch_size - 1) // self.batch_size
+        return len(self.image_paths) // self.batch_size
 
     def __getitem__(self, index):
-        # Create NumPy arrays that will hold the images and targets for one batch.
-        X = np.empty((self.batch_size, self.image_height, self.image_width, 3))
-        y_class = np.empty((self.batch_size), dtype=int)
-        y_bbox = np.empty((self.batch_size, 4))
-
         # Get the indices of the rows that this batch will use.
         batch_rows = self.rows[index * self.batch_size:(index + 1) * self.batch_size]
 
-        for i, row_index in enumerate(batch_rows):
-            # Read the row from the dataframe.
-            row = self.df.iloc[row_index]
-
-            # Load the image, preprocess it using the standard MobileNet normalization,
-            # and put it as a NumPy array into the batch (X).
-            image_id = row["image_id"]
-            folder = row["folder"]
-            image_path = os.path.join(self.image_dir, folder, image_id + ".jpg")
-            img = image.load_img(image_path, target_size=(self.image_width, self.image_height))
-            img = image.img_to_array(img)
-            img = preprocess_input(img)
-            X[i, :] = img
-
-            # Convert the class name to a label index, put it into the batch (y_class).
-            class_name = row["class_name"]
-            class_index = label2index[class_name]
-            y_class[i] = class_index
-
-            # Get the bounding box coordinates, put them into the batch (y_bbox).
-            # This is a second target. Because we have two losses, we need two targets.
-            # Note that we keep the bounding box coordinates as values between 0 and 1,
-            # so they are independent of the size of the image.
-            x_min = row["x_min"]
-            x_max = row["x_max"]
-            y_min = row["y_min"]
-            y_max = row["y_max"]
-            y_bbox[i, :] = np.array([x_min, x_max, y_min, y_max])
+        # Load the images into this batch's buffer, and preprocess them using
+        # the standard MobileNet normalization unless uint8 pixels were asked for.
+        # The last batch may be smaller, so only part of the buffer is used.
+        with self.buffer_lock:
+            buffer_index = self.next_buffer
+            self.next_buffer = (self.next_buffer + 1) % len(self.X_buffers)
+        X = self.load_images(batch_rows, out=self.X_buffers[buffer_index, :len(batch_rows)])
+        if self.dtype != np.uint8:
+            X = preprocess_input(X)
+
+        # The class indices and the bounding box coordinates are the two targets.
+        # Because we have two losses, we need two targets. Note that we keep the
+        # bounding box coordinates as values between 0 and 1, so they are
+        # independent of the size of the image.
+        y_class = self.class_indices[batch_rows]
+        y_bbox = self.bboxes[batch_rows]
 
         return X, [y_class, y_bbox]
 
     def on_epoch_end(self):
-        self.rows = np.arange(len(self.df))
+        self.rows = np.arange(len(self.image_paths))
         if self.shuffle:
             np.random.shuffle(self.rows)
 
+    def load_image(self, row_index):
+        img = image.load_img(self.image_paths[row_index],
+                             target_size=(self.image_height, self.image_width))
+        return np.asarray(img, dtype=np.uint8)
+
+    def load_images(self, row_indices, out=None):
+        """Returns the resized images for the given rows as a uint8 array,
+        from the cache if there is one, otherwise by decoding the JPEGs in
+        parallel. The images are written into out if it is given, which may
+        also be a float array.
+        """
+        if out is None:
+            out = np.empty((len(row_indices), self.image_height, self.image_width, 3),
+                           dtype=np.uint8)
+        if self.cache is not None:
+            # Copied row by row, so a float out doesn't need a uint8 copy of
+            # the whole batch first.
+            for i, row_index in enumerate(row_indices):
+                out[i] = self.cache[row_index]
+            return out
+
+        # Threads don't survive a fork, so workers started by fit_generator
+        # with use_multiprocessing=True need their own pool.
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+            self.executor_pid = os.getpid()
+
+        def load(i):
+            out[i] = self.load_image(row_indices[i])
+        list(self.executor.map(load, range(len(row_indices))))
+        return out
+
+    def open_cache(self, cache_path, chunk_size=256):
+        """Memory-maps the image cache at cache_path, building it first if it
+        doesn't exist or was made for other images or another image size.
+        """
+        shape = (len(self.image_paths), self.image_height, self.image_width, 3)
+        key = {"shape": list(shape), "image_paths": self.image_paths.tolist()}
+        key_path = cache_path + ".json"
+
+        if os.path.exists(cache_path) and os.path.exists(key_path):
+            with open(key_path) as f:
+                if json.load(f) == key:
+                    return np.load(cache_path, mmap_mode="r")
+
+        # The key is only written once the cache is complete, so a build
+        # that gets interrupted is started over next time.
+        if os.path.exists(key_path):
+            os.remove(key_path)
+        cache = np.lib.format.open_memmap(cache_path, mode="w+", dtype=np.uint8, shape=shape)
+        for start in range(0, shape[0], chunk_size):
+            row_indices = np.arange(start, min(start + chunk_size, shape[0]))
+            cache[row_indices] = self.load_images(row_indices)
+        cache.flush()
+        del cache
+        with open(key_path, "w") as f:
+            json.dump(key, f)
+
+        return np.load(cache_path, mmap_mode="r")
+
+
+def normalize_pixels(x):
+    """MobileNet's preprocess_input for a tensor of pixels from 0 to 255."""
+    return x / 127.5 - 1.
+
+
+def normalization_layer(name="normalize_pixels"):
+    """Returns a layer that normalizes pixels the way preprocess_input does,
+    to put at the start of a model that is trained with the uint8 batches of
+    BoundingBoxGenerator(dtype=np.uint8). Keras converts the uint8 batches
+    to the input's float type when feeding them to the model.
+    """
+    return keras.layers.Lambda(normalize_pixels, name=name)
+
 
 from collections import defaultdict
 
@@ -183,17 +300,63 @@ def iou(coords_true, coords_pred):
     return iou
 
 
+def batch_iou(boxes_true, boxes_pred):
+    """Computes the IOU of each pair of corresponding boxes at once.
+    Boxes are arrays whose last axis is (xmin, xmax, ymin, ymax); the other
+    axes are broadcast against each other, so boxes of shape (N, 4) give N
+    values.
+    """
+    boxes_true = np.asarray(boxes_true, dtype=np.float32)
+    boxes_pred = np.asarray(boxes_pred, dtype=np.float32)
+    minx = np.maximum(boxes_true[..., 0], boxes_pred[..., 0])
+    maxx = np.minimum(boxes_true[..., 1], boxes_pred[..., 1])
+    miny = np.maximum(boxes_true[..., 2], boxes_pred[..., 2])
+    maxy = np.minimum(boxes_true[..., 3], boxes_pred[..., 3])
+    inters = np.maximum(maxx - minx, 0.) * np.maximum(maxy - miny, 0.)
+    area_pred = (boxes_pred[..., 1] - boxes_pred[..., 0]) * \
+                (boxes_pred[..., 3] - boxes_pred[..., 2])
+    area_true = (boxes_true[..., 1] - boxes_true[..., 0]) * \
+                (boxes_true[..., 3] - boxes_true[..., 2])
+    return inters / (area_true + area_pred - inters)
+
+
+def pairwise_iou(boxes1, boxes2):
+    """Returns the N x M matrix with the IOU of every box in boxes1, shape
+    (N, 4), with every box in boxes2, shape (M, 4).
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float32)
+    boxes2 = np.asarray(boxes2, dtype=np.float32)
+    return batch_iou(boxes1[:, np.newaxis, :], boxes2[np.newaxis, :, :])
+
+
+def tf_batch_iou(boxes_true, boxes_pred):
+    """TensorFlow version of batch_iou."""
+    minx = tf.maximum(boxes_true[..., 0], boxes_pred[..., 0])
+    maxx = tf.minimum(boxes_true[..., 1], boxes_pred[..., 1])
+    miny = tf.maximum(boxes_true[..., 2], boxes_pred[..., 2])
+    maxy = tf.minimum(boxes_true[..., 3], boxes_pred[..., 3])
+    inters = tf.maximum(maxx - minx, 0.) * tf.maximum(maxy - miny, 0.)
+    area_pred = (boxes_pred[..., 1] - boxes_pred[..., 0]) * \
+                (boxes_pred[..., 3] - boxes_pred[..., 2])
+    area_true = (boxes_true[..., 1] - boxes_true[..., 0]) * \
+                (boxes_true[..., 3] - boxes_true[..., 2])
+    return inters / (area_true + area_pred - inters)
+
+
+def tf_pairwise_iou(boxes1, boxes2):
+    """TensorFlow version of pairwise_iou."""
+    return tf_batch_iou(tf.expand_dims(boxes1, 1), tf.expand_dims(boxes2, 0))
+
+
 # Based on code from https://www.davidtvs.com/keras-custom-metrics/
 class MeanIOU(object):
     def mean_iou(self, y_true, y_pred):
-        # Wraps np_mean_iou method and uses it as a TensorFlow op.
-        # Takes numpy arrays as its arguments and returns numpy arrays as
-        # its outputs.
-        return tf.py_func(self.np_mean_iou, [y_true, y_pred], tf.float32)
+        # Computes the IOU of every box in the batch with regular TensorFlow
+        # ops, so the metric runs inside the graph instead of calling back
+        # into Python on every step.
+        y_true = tf.cast(y_true, tf.float32)
+        y_pred = tf.cast(y_pred, tf.float32)
+        return tf.reduce_mean(tf_batch_iou(y_true, y_pred))
 
     def np_mean_iou(self, y_true, y_pred):
-        ious = np.zeros(len(y_true), dtype=np.float32)
-        for i in range(len(y_true)):
-            ious[i] = iou(y_true[i], y_pred[i])
-        return ious.mean()
-
+        return batch_iou(y_true, y_pred).mean()
@@ -0,0 +1,81 @@
+import os
+import numpy as np
+import pandas as pd
+import turicreate as tc
+
+
+def annotations_by_image(annotations, image_ids, image_widths, image_heights):
+    """Matches the rows of the annotations dataframe to the images.
+    The annotations are joined to the images on image_id in one pass, and
+    their coordinates, which the CSV stores as numbers between 0 and 1, are
+    converted to Turi's pixel coordinates for all boxes at once.
+    Returns a list with, for every image, a list of Turi annotation
+    dictionaries, or None if the image has no annotations.
+    """
+    images = pd.DataFrame({"image_id": image_ids,
+                           "image_index": np.arange(len(image_ids)),
+                           "image_width": image_widths,
+                           "image_height": image_heights})
+    boxes = annotations.merge(images, on="image_id", how="inner")
+    boxes = boxes.sort_values("image_index", kind="mergesort")
+
+    img_width = boxes["image_width"].values
+    img_height = boxes["image_height"].values
+    xmin = np.round(boxes["x_min"].values * img_width).astype(int)
+    xmax = np.round(boxes["x_max"].values * img_width).astype(int)
+    ymin = np.round(boxes["y_min"].values * img_height).astype(int)
+    ymax = np.round(boxes["y_max"].values * img_height).astype(int)
+
+    # A bounding box in Turi is given by a center coordinate and the
+    # width and height, we have them as the four corners of the box.
+    width = xmax - xmin
+    height = ymax - ymin
+    x = xmin + width // 2
+    y = ymin + height // 2
+
+    all_annotations = [None] * len(image_ids)
+    for image_index, h, w, cx, cy, class_name in zip(boxes["image_index"].values,
+                                                     height.tolist(), width.tolist(),
+                                                     x.tolist(), y.tolist(),
+                                                     boxes["class_name"].values):
+        if all_annotations[image_index] is None:
+            all_annotations[image_index] = []
+        all_annotations[image_index].append({"coordinates": {"height": h,
+                                                             "width": w,
+                                                             "x": cx,
+                                                             "y": cy},
+                                             "label": class_name})
+    return all_annotations
+
+
+def image_sizes(paths):
+    """Returns the widths and heights of the image files as two arrays.
+    Only the file headers are read, which PIL does without decoding the
+    pixels, so this is much cheaper than asking Turi for the size of every
+    loaded image, which runs a Python function in Turi's workers for each
+    one and sends them the whole image.
+    """
+    from PIL import Image
+    sizes = np.zeros((len(paths), 2), dtype=int)
+    for i, path in enumerate(paths):
+        with Image.open(path) as img:
+            sizes[i] = img.size
+    return sizes[:, 0], sizes[:, 1]
+
+
+def load_images_with_annotations(images_dir, annotations_file):
+    """Loads the images into a Turi SFrame with an "annotations" column
+    holding their bounding boxes from the CSV file. Only the images that
+    have annotations are kept.
+    """
+    data = tc.image_analysis.load_images(images_dir, with_path=True)
+    annotations = pd.read_csv(annotations_file)
+
+    paths = list(data["path"])
+    image_ids = [os.path.basename(path)[:-4] for path in paths]
+    image_widths, image_heights = image_sizes(paths)
+
+    all_annotations = annotations_by_image(annotations, image_ids,
+                                           image_widths, image_heights)
+    data["annotations"] = tc.SArray(data=all_annotations, dtype=list)
+    return data.dropna()
@@ -0,0 +1,209 @@
+"""Non-maximum suppression and box post-processing with NumPy.
+
+Boxes are (xmin, xmax, ymin, ymax), as in the localization chapter, in any
+units as long as they are the same for all boxes. Use from_center() to
+convert boxes given as (center x, center y, width, height), as Turi Create
+does.
+
+Run this file to compare the speed of nms() with a plain Python loop.
+"""
+import time
+import numpy as np
+
+
+def from_center(boxes):
+    """Converts boxes from (x, y, width, height), where (x, y) is the center,
+    to (xmin, xmax, ymin, ymax).
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    x, y, w, h = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+    return np.stack([x - w/2, x + w/2, y - h/2, y + h/2], axis=-1)
+
+
+def iou_one_to_many(box, boxes):
+    """Returns the IOU of a single box with each of the (N, 4) boxes."""
+    minx = np.maximum(box[0], boxes[:, 0])
+    maxx = np.minimum(box[1], boxes[:, 1])
+    miny = np.maximum(box[2], boxes[:, 2])
+    maxy = np.minimum(box[3], boxes[:, 3])
+    inters = np.maximum(maxx - minx, 0.) * np.maximum(maxy - miny, 0.)
+    area = (box[1] - box[0]) * (box[3] - box[2])
+    areas = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+    return inters / np.maximum(area + areas - inters, 1e-12)
+
+
+def offset_by_class(boxes, classes):
+    """Shifts the boxes of every class to their own region of the plane, so
+    boxes of different classes never overlap. Running class-agnostic NMS on
+    the shifted boxes then gives the same result as running it per class.
+    """
+    extent = boxes.max() - boxes.min() + 1
+    return boxes + (np.asarray(classes, dtype=np.float32) * extent)[:, np.newaxis]
+
+
+def nms(boxes, scores, iou_threshold=0.5, score_threshold=None, max_outputs=None,
+        classes=None):
+    """Greedy non-maximum suppression.
+    Keeps the highest scoring box, removes all remaining boxes that overlap
+    it with an IOU above iou_threshold, and repeats with what is left.
+    Boxes scoring below score_threshold are dropped first. If classes is
+    given, boxes only suppress boxes of their own class.
+    Returns the indices of the kept boxes, from highest to lowest score.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    scores = np.asarray(scores, dtype=np.float32)
+    if classes is not None and len(boxes):
+        boxes = offset_by_class(boxes, classes)
+
+    order = np.argsort(-scores, kind="stable")
+    if score_threshold is not None:
+        order = order[scores[order] >= score_threshold]
+
+    keep = []
+    while len(order) and (max_outputs is None or len(keep) < max_outputs):
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        order = rest[iou_one_to_many(boxes[best], boxes[rest]) <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+
+def soft_nms(boxes, scores, iou_threshold=0.3, sigma=0.5, score_threshold=0.001,
+             method="gaussian", max_outputs=None, classes=None):
+    """Soft non-maximum suppression (Bodla et al., 2017).
+    Instead of removing the boxes that overlap a kept box, their scores are
+    lowered: by a factor exp(-iou^2 / sigma) with method="gaussian", or by
+    (1 - iou) for boxes with an IOU above iou_threshold with method="linear".
+    Boxes whose score falls below score_threshold are dropped.
+    Returns the indices of the kept boxes and their new scores, from
+    highest to lowest score.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    if classes is not None and len(boxes):
+        boxes = offset_by_class(boxes, classes)
+
+    remaining = np.arange(len(boxes))
+    remaining_scores = np.array(scores, dtype=np.float32)
+    keep = remaining_scores >= score_threshold
+    remaining, remaining_scores = remaining[keep], remaining_scores[keep]
+
+    keep, kept_scores = [], []
+    while len(remaining) and (max_outputs is None or len(keep) < max_outputs):
+        i = np.argmax(remaining_scores)
+        best = remaining[i]
+        keep.append(best)
+        kept_scores.append(remaining_scores[i])
+
+        remaining = np.delete(remaining, i)
+        remaining_scores = np.delete(remaining_scores, i)
+        ious = iou_one_to_many(boxes[best], boxes[remaining])
+        if method == "linear":
+            remaining_scores *= np.where(ious > iou_threshold, 1. - ious, 1.)
+        elif method == "gaussian":
+            remaining_scores *= np.exp(-ious**2 / sigma)
+        else:
+            raise ValueError("Unknown soft-NMS method: %s" % method)
+
+        keep_mask = remaining_scores >= score_threshold
+        remaining, remaining_scores = remaining[keep_mask], remaining_scores[keep_mask]
+
+    return np.array(keep, dtype=int), np.array(kept_scores, dtype=np.float32)
+
+
+def postprocess_batch(boxes, scores, classes=None, iou_threshold=0.5, score_threshold=0.01,
+                      top_k=100, class_agnostic=False, soft=False, **soft_nms_args):
+    """Filters the predictions for a whole batch of images.
+    boxes has shape (batch, N, 4), or is a list with one (N, 4) array per
+    image. scores holds one score per box, or a row of class probabilities
+    per box, in which case the best class and its probability are used.
+    Boxes below score_threshold are dropped before suppression, then
+    (soft) NMS keeps at most top_k boxes per image, either per class
+    or across all classes if class_agnostic is True. With soft=True, any
+    other keyword arguments go to soft_nms, and iou_threshold is passed on
+    as well, although only its method="linear" uses it.
+    Returns a list with a (boxes, scores, classes) tuple for every image;
+    classes is None if no classes were given.
+    """
+    results = []
+    for i in range(len(boxes)):
+        image_boxes = np.asarray(boxes[i], dtype=np.float32)
+        image_scores = np.asarray(scores[i], dtype=np.float32)
+        image_classes = None if classes is None else np.asarray(classes[i])
+        if image_scores.ndim == 2:
+            image_classes = np.argmax(image_scores, axis=-1)
+            image_scores = image_scores[np.arange(len(image_scores)), image_classes]
+
+        candidates = np.flatnonzero(image_scores >= score_threshold)
+        image_boxes = image_boxes[candidates]
+        image_scores = image_scores[candidates]
+        if image_classes is not None:
+            image_classes = image_classes[candidates]
+        nms_classes = None if class_agnostic else image_classes
+
+        if soft:
+            soft_nms_args.setdefault("iou_threshold", iou_threshold)
+            soft_nms_args.setdefault("score_threshold", score_threshold)
+            keep, image_scores = soft_nms(image_boxes, image_scores, max_outputs=top_k,
+                                          classes=nms_classes, **soft_nms_args)
+        else:
+            keep = nms(image_boxes, image_scores, iou_threshold, max_outputs=top_k,
+                       classes=nms_classes)
+            image_scores = image_scores[keep]
+
+        results.append((image_boxes[keep], image_scores,
+                        None if image_classes is None else image_classes[keep]))
+    return results
+
+
+def naive_nms(boxes, scores, iou_threshold=0.5):
+    """Greedy NMS with plain Python loops, for comparison with nms()."""
+    def iou(a, b):
+        inters = max(min(a[1], b[1]) - max(a[0], b[0]), 0.) * \
+                 max(min(a[3], b[3]) - max(a[2], b[2]), 0.)
+        union = (a[1] - a[0]) * (a[3] - a[2]) + (b[1] - b[0]) * (b[3] - b[2]) - inters
+        return inters / max(union, 1e-12)
+
+    order = sorted(range(len(boxes)), key=lambda i: -scores[i])
+    keep = []
+    for i in order:
+        if all(iou(boxes[i], boxes[j]) <= iou_threshold for j in keep):
+            keep.append(i)
+    return keep
+
+
+def random_boxes(count, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.rand(count, 2)
+    sizes = rng.uniform(0.05, 0.3, size=(count, 2))
+    boxes = from_center(np.concatenate([centers, sizes], axis=1))
+    return boxes, rng.rand(count).astype(np.float32)
+
+
+def benchmark(box_counts=(10, 100, 1000, 5000), repeats=3):
+    """Times nms(), soft_nms() and naive_nms() on random boxes.
+    Returns a list of (box count, nms ms, soft-NMS ms, naive ms) tuples.
+    """
+    def best_time(fn):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000
+
+    results = []
+    for count in box_counts:
+        boxes, scores = random_boxes(count)
+        box_list, score_list = boxes.tolist(), scores.tolist()
+        results.append((count,
+                        best_time(lambda: nms(boxes, scores)),
+                        best_time(lambda: soft_nms(boxes, scores)),
+                        best_time(lambda: naive_nms(box_list, score_list))))
+    return results
+
+
+if __name__ == "__main__":
+    print("%8s %12s %12s %12s %8s" % ("boxes", "nms ms", "soft ms", "naive ms", "speedup"))
+    for count, nms_ms, soft_ms, naive_ms in benchmark():
+        print("%8d %12.3f %12.3f %12.3f %7.1fx" % (count, nms_ms, soft_ms, naive_ms,
+                                                   naive_ms / nms_ms))
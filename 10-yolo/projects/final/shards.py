@@ -0,0 +1,195 @@
+"""Sharded on-disk storage for the snacks detection dataset.
+
+write_shards() packs the JPEG files and their bounding boxes into a folder of
+shards. Each shard has two files:
+
+    shard-00000.images   the JPEG files, one after the other
+    shard-00000.npz      image_ids, image_offsets, box_offsets, boxes, labels
+
+image_offsets[i]:image_offsets[i+1] are the bytes of image i in the .images
+file, and box_offsets[i]:box_offsets[i+1] are its rows in boxes and labels.
+Boxes are (x_min, x_max, y_min, y_max) between 0 and 1, as in the annotation
+CSV files, and labels index into the class_names listed in index.json.
+
+ShardedDataset reads records by index without loading the images into
+memory, and streams them in an order that is shuffled across shards and can
+be divided between worker processes.
+"""
+import io
+import json
+import os
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+
+INDEX_FILENAME = "index.json"
+
+DetectionRecord = namedtuple("DetectionRecord", ["image_id", "image_bytes", "boxes", "labels"])
+
+
+def shard_name(shard_index):
+    return "shard-%05d" % shard_index
+
+
+def write_shards(annotations, image_dir, path, images_per_shard=1000, class_names=None):
+    """Writes the images of the annotations dataframe, which has the columns of
+    the annotations CSV files, and their boxes as shards into the folder path.
+    Images are read from image_dir/folder/image_id.jpg, or from
+    image_dir/image_id.jpg if there is no folder column. Every image is stored
+    once, together with all of its boxes.
+    Returns the number of images written.
+    """
+    if class_names is None:
+        class_names = sorted(annotations["class_name"].unique())
+    label2index = {name: i for i, name in enumerate(class_names)}
+
+    # Put the boxes of each image next to each other, keeping the image order.
+    keys = ["folder", "image_id"] if "folder" in annotations else ["image_id"]
+    image_codes = annotations.groupby(keys, sort=False).ngroup().values
+    order = np.argsort(image_codes, kind="stable")
+    annotations = annotations.iloc[order]
+    image_codes = image_codes[order]
+    num_images = int(image_codes[-1]) + 1 if len(image_codes) else 0
+    box_counts = np.bincount(image_codes, minlength=num_images)
+    box_offsets = np.concatenate(([0], np.cumsum(box_counts))).astype(np.int64)
+
+    first_rows = annotations.iloc[box_offsets[:-1]]
+    image_ids = np.array(first_rows["image_id"].tolist(), dtype=str)
+    folders = first_rows["folder"].values if "folder" in annotations else [""] * num_images
+    boxes = annotations[["x_min", "x_max", "y_min", "y_max"]].values.astype(np.float32)
+    labels = annotations["class_name"].map(label2index).values.astype(np.int16)
+
+    os.makedirs(path, exist_ok=True)
+    shards = []
+    for shard_index, start in enumerate(range(0, num_images, images_per_shard)):
+        end = min(start + images_per_shard, num_images)
+        name = shard_name(shard_index)
+
+        image_offsets = [0]
+        with open(os.path.join(path, name + ".images"), "wb") as f:
+            for image_id, folder in zip(image_ids[start:end], folders[start:end]):
+                with open(os.path.join(image_dir, folder, image_id + ".jpg"), "rb") as img:
+                    image_offsets.append(image_offsets[-1] + f.write(img.read()))
+
+        box_start, box_end = box_offsets[start], box_offsets[end]
+        np.savez(os.path.join(path, name + ".npz"),
+                 image_ids=image_ids[start:end],
+                 image_offsets=np.array(image_offsets, dtype=np.int64),
+                 box_offsets=box_offsets[start:end + 1] - box_start,
+                 boxes=boxes[box_start:box_end],
+                 labels=labels[box_start:box_end])
+        shards.append({"name": name, "count": end - start})
+
+    # The index is written last, so a folder without one is incomplete.
+    with open(os.path.join(path, INDEX_FILENAME), "w") as f:
+        json.dump({"class_names": list(class_names), "shards": shards}, f)
+    return num_images
+
+
+class ShardedDataset(object):
+    """Random access to the records in a folder written by write_shards.
+    The image files are memory-mapped and a shard's arrays are only loaded
+    when one of its records is first read, so opening the dataset is cheap
+    whatever its size. At most max_open_shards shards are kept open; the
+    least recently used one is closed to make room for another, so reading
+    a large dataset doesn't run out of file descriptors. Keep it at least
+    the shuffle_window passed to stream, or shards get reopened over and
+    over. The dataset can be passed to worker processes; each process opens
+    the shards again.
+    """
+    def __init__(self, path, max_open_shards=16):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILENAME)) as f:
+            index = json.load(f)
+        self.class_names = index["class_names"]
+        self.shard_names = [shard["name"] for shard in index["shards"]]
+        counts = [shard["count"] for shard in index["shards"]]
+        self.shard_starts = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.max_open_shards = max_open_shards
+        self.shards = OrderedDict()
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = OrderedDict()
+        return state
+
+    def shard(self, shard_index):
+        """Returns the arrays and the memory-mapped image bytes of a shard."""
+        if shard_index in self.shards:
+            self.shards.move_to_end(shard_index)
+        else:
+            name = self.shard_names[shard_index]
+            with np.load(os.path.join(self.path, name + ".npz")) as arrays:
+                shard = {key: arrays[key] for key in arrays.files}
+            images_path = os.path.join(self.path, name + ".images")
+            if os.path.getsize(images_path) > 0:
+                shard["images"] = np.memmap(images_path, dtype=np.uint8, mode="r")
+            else:
+                shard["images"] = np.zeros(0, dtype=np.uint8)
+            self.shards[shard_index] = shard
+            while len(self.shards) > self.max_open_shards:
+                self.shards.popitem(last=False)
+        return self.shards[shard_index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        shard_index = int(np.searchsorted(self.shard_starts, index, side="right")) - 1
+        shard = self.shard(shard_index)
+        i = index - self.shard_starts[shard_index]
+
+        image_start, image_end = shard["image_offsets"][i], shard["image_offsets"][i + 1]
+        box_start, box_end = shard["box_offsets"][i], shard["box_offsets"][i + 1]
+        return DetectionRecord(image_id=str(shard["image_ids"][i]),
+                               image_bytes=shard["images"][image_start:image_end].tobytes(),
+                               boxes=shard["boxes"][box_start:box_end],
+                               labels=shard["labels"][box_start:box_end])
+
+    def epoch_order(self, epoch=0, shuffle=True, seed=0, shuffle_window=4,
+                    worker_id=0, num_workers=1):
+        """Returns the record indices to read in the given epoch.
+        When shuffling, the shards are visited in a random order, and the
+        records of each group of shuffle_window shards are shuffled together,
+        so records mix across shards while only a few shards are read at a
+        time. The order only depends on seed and epoch, so every worker
+        computes the same one and takes every num_workers-th record of it,
+        starting at worker_id. Together the workers read each record once.
+        """
+        num_shards = len(self.shard_names)
+        if not shuffle:
+            order = np.arange(len(self))
+        else:
+            rng = np.random.RandomState([seed, epoch])
+            shard_order = rng.permutation(num_shards)
+            groups = []
+            for start in range(0, num_shards, shuffle_window):
+                group = np.concatenate([np.arange(self.shard_starts[s], self.shard_starts[s + 1])
+                                        for s in shard_order[start:start + shuffle_window]])
+                groups.append(rng.permutation(group))
+            order = np.concatenate(groups) if groups else np.arange(0)
+        return order[worker_id::num_workers]
+
+    def stream(self, epoch=0, shuffle=True, seed=0, shuffle_window=4,
+               worker_id=0, num_workers=1):
+        """Yields the DetectionRecords of one epoch in the order given by
+        epoch_order.
+        """
+        for index in self.epoch_order(epoch, shuffle, seed, shuffle_window,
+                                      worker_id, num_workers):
+            yield self[index]
+
+
+def decode_image(image_bytes, image_height, image_width):
+    """Decodes the JPEG bytes of a record into a uint8 array of the given
+    size, resizing the same way keras.preprocessing.image.load_img does.
+    """
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    if img.size != (image_width, image_height):
+        img = img.resize((image_width, image_height), Image.NEAREST)
+    return np.asarray(img, dtype=np.uint8)
@@ -28,76 +28,596 @@
 /// THE SOFTWARE.
 '''
 
+import json
+import os
+import shutil
+import time
+import numpy as np
 import pandas as pd
 import turicreate as tc
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from glob import glob
 from pathlib import Path
-        
+
+'''
+  The columns found in every .csv file created by the GestureDataRecorder app,
+  in the order that app writes them, along with the type of each column. If
+  any changes are made to the features recorded by that app (different
+  features or different order) then these need to be changed to match.
+'''
+CSV_COLUMNS = ['sessionId', 'activity',
+               'roll', 'pitch', 'yaw',
+               'rotX', 'rotY', 'rotZ',
+               'gravX', 'gravY', 'gravZ',
+               'accelX', 'accelY', 'accelZ']
+SENSOR_COLUMNS = CSV_COLUMNS[2:]
+CSV_DTYPES = dict({'sessionId': str, 'activity': int},
+                  **{col: float for col in SENSOR_COLUMNS})
+
+# Must match Config.samplesPerSecond in the GestureDataRecorder app.
+SAMPLES_PER_SECOND = 25.0
+
+'''
+  Names used inside the cache_dir given to sframe_from_folder. The cached SFrame
+  keeps an extra SOURCE_FILE_COLUMN so rows can be dropped when their file
+  changes or disappears; that column is never returned to the caller.
+'''
+CACHED_SFRAME_DIRNAME = 'gestures.sframe'
+MANIFEST_FILENAME = 'manifest.json'
+SOURCE_FILE_COLUMN = 'sourceFile'
+ROW_NUMBER_COLUMN = 'rowNumber'
+
 '''
   sframe_from_folder: Given the path to a folder, this function reads all the
                       .csv files in that folder and creates a Turi Create SFrame
-                      containing their data. The columns are renamed to match the
+                      containing their data. The columns are named to match the
                       features they contain, and a new "userId" column is added.
                       The csv files in folder should be created with the
-                      GestureDataRecorder app. If any changes are made to the 
-                      features recorded by that app (different features or different order)
-                      then this code needs to be changed to match.
+                      GestureDataRecorder app.
+
+                      Files are parsed concurrently by a pool of num_workers
+                      threads (or processes, if use_processes is True) and
+                      combined with a single concatenation, so load time grows
+                      linearly with the number of files. Set verbose to True
+                      to print how many files/sec and rows/sec were loaded.
+
+                      If cache_dir is given, the combined data is saved there
+                      along with a manifest of each file's size and modification
+                      time. Later calls only parse files that are new or have
+                      changed since then, and drop the rows of deleted files.
 '''
-def sframe_from_folder(folder):
-    train_files = glob(f"{folder}/*.csv")
+def sframe_from_folder(folder, num_workers=None, use_processes=False, verbose=False,
+                       cache_dir=None):
+    train_files = sorted(os.path.abspath(f) for f in glob(f"{folder}/*.csv"))
     
     if len(train_files) == 0:
         return None
     
-    sf = append_uid_column(tc.SFrame.read_csv(train_files[0], header=False), train_files[0])
-    for f in train_files[1:]:
-        sf = sf.append(append_uid_column(tc.SFrame.read_csv(f, header=False), f))
-        
-    sf.rename(({'X1':'sessionId', 'X2':'activity',
-                'X3':'roll', 'X4':'pitch', 'X5':'yaw',
-                'X6':'rotX', 'X7':'rotY', 'X8':'rotZ',
-                'X9':'gravX', 'X10':'gravY', 'X11':'gravZ',
-                'X12':'accelX', 'X13':'accelY', 'X14':'accelZ'}),inplace=True)
+    if cache_dir is not None:
+        return cached_sframe_from_files(train_files, cache_dir, num_workers,
+                                        use_processes, verbose)
+    
+    start_time = time.time()
+    sf = tc.SFrame(dataframe_from_files(train_files, num_workers, use_processes))
+    if verbose:
+        print_load_rate(len(train_files), len(sf), start_time)
     return sf
 
+'''
+  cached_sframe_from_files: Does the work of sframe_from_folder when it's given a
+                            cache_dir. Reuses the rows of every file whose size
+                            and modification time match the manifest, parses
+                            the rest, and rewrites the cache only if something
+                            changed.
+'''
+def cached_sframe_from_files(files, cache_dir, num_workers=None, use_processes=False,
+                             verbose=False):
+    start_time = time.time()
+    sframe_path = os.path.join(cache_dir, CACHED_SFRAME_DIRNAME)
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILENAME)
+
+    manifest = {}
+    if os.path.exists(manifest_path) and os.path.exists(sframe_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    signatures = {f: file_signature(f) for f in files}
+    unchanged = {f for f in files if manifest.get(f) == signatures[f]}
+    changed = [f for f in files if f not in unchanged]
+    num_deleted = len([f for f in manifest if f not in signatures])
+
+    if len(changed) == 0 and num_deleted == 0:
+        sf = tc.SFrame(sframe_path)
+    else:
+        sf = None
+        if len(unchanged) > 0:
+            sf = tc.SFrame(sframe_path)
+            # filter_by runs natively instead of calling Python for every row,
+            # but it doesn't keep the row order, which each file's samples
+            # depend on, so the rows are sorted back afterwards.
+            sf = sf.add_row_number(ROW_NUMBER_COLUMN)
+            sf = sf.filter_by(list(unchanged), SOURCE_FILE_COLUMN)
+            sf = sf.sort(ROW_NUMBER_COLUMN).remove_column(ROW_NUMBER_COLUMN)
+        if len(changed) > 0:
+            new_sf = tc.SFrame(dataframe_from_files(changed, num_workers, use_processes,
+                                                    source_column=SOURCE_FILE_COLUMN))
+            sf = new_sf if sf is None else sf.append(new_sf)
+
+        # Save next to the old cache and swap it in, because sf may still be
+        # reading from the old one.
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = sframe_path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        sf.save(tmp_path)
+        if os.path.exists(sframe_path):
+            shutil.rmtree(sframe_path)
+        os.rename(tmp_path, sframe_path)
+        with open(manifest_path, 'w') as f:
+            json.dump(signatures, f)
+        sf = tc.SFrame(sframe_path)
+
+    if verbose:
+        print(f"Parsed {len(changed)} new or changed files, reused {len(unchanged)} "
+              f"cached files, dropped {num_deleted} deleted files.")
+        print_load_rate(len(files), len(sf), start_time)
+    return sf.remove_column(SOURCE_FILE_COLUMN)
+
+'''
+  file_signature: Returns the [modification time, size] pair that the cache
+                  manifest stores for the file at path.
+'''
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+'''
+  dataframe_from_files: Reads the given GestureDataRecorder .csv files with a pool
+                        of num_workers threads, or processes if use_processes is
+                        True, and returns them as a single Pandas DataFrame. If
+                        source_column is given, a column with that name holds
+                        the path each row was read from.
+'''
+def dataframe_from_files(files, num_workers=None, use_processes=False, source_column=None):
+    pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_class(max_workers=num_workers) as pool:
+        frames = list(pool.map(partial(dataframe_from_csv, source_column=source_column),
+                               files))
+    return pd.concat(frames, ignore_index=True)
+
+'''
+  dataframe_from_csv: Helper function that reads a single GestureDataRecorder
+                      .csv file into a Pandas DataFrame using the explicit
+                      column names and types in CSV_COLUMNS and CSV_DTYPES,
+                      and fills in its "userId" column while reading.
+'''
+def dataframe_from_csv(path, source_column=None):
+    df = pd.read_csv(path, header=None, names=CSV_COLUMNS, dtype=CSV_DTYPES)
+    df['userId'] = uid_from_path(path)
+    if source_column is not None:
+        df[source_column] = path
+    return df
+
+'''
+  print_load_rate: Prints how quickly num_files files containing num_rows rows
+                   were loaded, given the time.time() at which loading started.
+'''
+def print_load_rate(num_files, num_rows, start_time):
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"Loaded {num_files} files ({num_rows} rows) in {elapsed:.2f} sec: "
+          f"{num_files / elapsed:.1f} files/sec, {num_rows / elapsed:.0f} rows/sec")
+
+'''
+  stream_window_batches: Reads the GestureDataRecorder .csv files in folder one
+                         chunk_size chunk at a time and yields a tuple of
+                         (sessionId, userId, activities, windows) for every run
+                         of prediction windows found in a chunk. windows has shape
+                         (num_windows, window_size, len(features)) and activities
+                         holds the most common activity in each window.
+                         Consecutive windows start hop_size rows apart, so they
+                         overlap when hop_size is less than window_size, and a
+                         window never spans two sessions. Only one chunk plus
+                         the rows of one unfinished window are held in memory,
+                         no matter how large the files are.
+'''
+def stream_window_batches(folder, window_size=20, hop_size=None, features=None,
+                          chunk_size=10000):
+    if hop_size is None:
+        hop_size = max(window_size // 2, 1)
+    if features is None:
+        features = SENSOR_COLUMNS
+    window_offsets = np.arange(window_size)
+
+    for path in sorted(glob(f"{folder}/*.csv")):
+        uid = uid_from_path(path)
+        session_id = None
+        reader = pd.read_csv(path, header=None, names=CSV_COLUMNS, dtype=CSV_DTYPES,
+                             chunksize=chunk_size)
+        for chunk in reader:
+            sessions = chunk['sessionId'].values
+            chunk_values = chunk[features].values
+            chunk_labels = chunk['activity'].values
+
+            # Split the chunk into runs of rows that belong to the same session.
+            boundaries = np.flatnonzero(sessions[1:] != sessions[:-1]) + 1
+            run_starts = np.concatenate(([0], boundaries))
+            run_ends = np.concatenate((boundaries, [len(chunk)]))
+
+            for start, end in zip(run_starts, run_ends):
+                if sessions[start] != session_id:
+                    session_id = sessions[start]
+                    values = chunk_values[:0]
+                    labels = chunk_labels[:0]
+                    skip = 0
+
+                # Rows still to be skipped when hop_size is larger than window_size.
+                skipped = min(skip, end - start)
+                start += skipped
+                skip -= skipped
+
+                values = np.concatenate((values, chunk_values[start:end]))
+                labels = np.concatenate((labels, chunk_labels[start:end]))
+                num_windows = max((len(values) - window_size) // hop_size + 1, 0)
+                if num_windows > 0:
+                    index = (np.arange(num_windows) * hop_size)[:, np.newaxis] + window_offsets
+                    yield session_id, uid, majority_labels(labels[index]), values[index]
+
+                    # Keep only the rows needed by the next window.
+                    next_start = num_windows * hop_size
+                    skip = max(next_start - len(values), 0)
+                    values = values[next_start:]
+                    labels = labels[next_start:]
+
+'''
+  stream_window_features: Like stream_window_batches, but yields one dictionary per
+                          prediction window with its "sessionId", "userId" and
+                          "activity", plus the window_statistics of every feature
+                          in columns named like "rotX_mean" or "accelZ_energy".
+'''
+def stream_window_features(folder, window_size=20, hop_size=None, features=None,
+                           chunk_size=10000):
+    if features is None:
+        features = SENSOR_COLUMNS
+    batches = stream_window_batches(folder, window_size, hop_size, features, chunk_size)
+    for session_id, uid, activities, windows in batches:
+        stats = window_statistics(windows)
+        for i in range(len(windows)):
+            row = {'sessionId': session_id, 'userId': uid, 'activity': activities[i]}
+            for stat, stat_values in stats.items():
+                for j, feature in enumerate(features):
+                    row[f"{feature}_{stat}"] = stat_values[i, j]
+            yield row
+
+'''
+  window_statistics: Given an array of windows with shape (num_windows, window_size,
+                     num_features), or a single (window_size, num_features) window,
+                     returns a dictionary with the "mean", "std", "energy" (mean
+                     of the squared values) and "zero_crossings" (number of sign
+                     changes) of each feature in each window.
+'''
+def window_statistics(windows):
+    windows = np.asarray(windows, dtype=np.float64)
+    negative = np.signbit(windows)
+    return {'mean': windows.mean(axis=-2),
+            'std': windows.std(axis=-2),
+            'energy': np.square(windows).mean(axis=-2),
+            'zero_crossings': np.count_nonzero(negative[..., 1:, :] != negative[..., :-1, :],
+                                               axis=-2)}
+
+'''
+  majority_labels: Given a (num_windows, window_size) array of activity labels,
+                   returns the most common label in each window.
+'''
+def majority_labels(labels):
+    classes, inverse = np.unique(labels, return_inverse=True)
+    counts = np.zeros((labels.shape[0], len(classes)), dtype=int)
+    rows = np.repeat(np.arange(labels.shape[0]), labels.shape[1])
+    np.add.at(counts, (rows, inverse.ravel()), 1)
+    return classes[counts.argmax(axis=1)]
+
+'''
+  CompactGestures: The compact, columnar form of a gesture SFrame returned by
+                   load_compact. All rows of a session are stored next to each
+                   other, so session i spans rows session_offsets[i] up to
+                   session_offsets[i+1].
+                     features: names of the columns in values.
+                     values: float32 array of shape (num_rows, len(features)).
+                     activity_codes: index into activities for every row.
+                     activities: the distinct activity values.
+                     session_ids: the sessionId of every session.
+                     session_offsets: int64 array of num_sessions + 1 row offsets.
+                     user_codes: index into user_ids for every session.
+                     user_ids: the distinct userId values.
+'''
+CompactGestures = namedtuple('CompactGestures', [
+    'features', 'values', 'activity_codes', 'activities',
+    'session_ids', 'session_offsets', 'user_codes', 'user_ids'])
+
+COMPACT_INDEX_FILENAME = 'index.json'
+COMPACT_ARRAYS = ['values', 'activity_codes', 'session_offsets', 'user_codes']
+
+'''
+  factorize_with_missing: Like pd.factorize, but returns the distinct values as a
+                          list and gives missing values, such as the userId of a
+                          file name without a dash, their own code for a None
+                          at the end of that list instead of the code -1.
+'''
+def factorize_with_missing(values):
+    codes, uniques = pd.factorize(values)
+    uniques = uniques.tolist()
+    missing = codes < 0
+    if missing.any():
+        codes[missing] = len(uniques)
+        uniques.append(None)
+    return codes, uniques
+
+'''
+  save_compact: Stores the given gesture SFrame, as made by sframe_from_folder, in
+                the folder at path using the CompactGestures layout. The sensor
+                features become a single float32 .npy file and the activity and
+                userId columns are dictionary-encoded, which takes about half
+                the memory of the SFrame and can be memory-mapped by load_compact.
+'''
+def save_compact(sframe, path, features=None):
+    if features is None:
+        features = SENSOR_COLUMNS
+    df = sframe[['sessionId', 'activity', 'userId'] + list(features)].to_dataframe()
+
+    # Put the rows of each session next to each other, keeping their order.
+    session_codes, session_ids = factorize_with_missing(df['sessionId'])
+    order = np.argsort(session_codes, kind='stable')
+    df = df.iloc[order]
+    session_codes = session_codes[order]
+    session_lengths = np.bincount(session_codes, minlength=len(session_ids))
+    session_offsets = np.concatenate(([0], np.cumsum(session_lengths))).astype(np.int64)
+
+    activity_codes, activities = factorize_with_missing(df['activity'])
+    row_user_codes, user_ids = factorize_with_missing(df['userId'])
+
+    compact = CompactGestures(
+        features=list(features),
+        values=df[list(features)].values.astype(np.float32),
+        activity_codes=activity_codes.astype(np.min_scalar_type(len(activities))),
+        activities=activities,
+        session_ids=session_ids,
+        session_offsets=session_offsets,
+        user_codes=row_user_codes[session_offsets[:-1]].astype(
+            np.min_scalar_type(len(user_ids))),
+        user_ids=user_ids)
+
+    os.makedirs(path, exist_ok=True)
+    for name in COMPACT_ARRAYS:
+        np.save(os.path.join(path, name + '.npy'), getattr(compact, name))
+    with open(os.path.join(path, COMPACT_INDEX_FILENAME), 'w') as f:
+        json.dump({'features': compact.features, 'activities': compact.activities,
+                   'session_ids': compact.session_ids, 'user_ids': compact.user_ids}, f)
+    return compact
+
+'''
+  load_compact: Loads a CompactGestures saved by save_compact from the folder at
+                path. By default the arrays are memory-mapped read-only, so only
+                the rows that are actually used get read from disk. Pass
+                mmap_mode=None to load everything into memory instead.
+'''
+def load_compact(path, mmap_mode='r'):
+    with open(os.path.join(path, COMPACT_INDEX_FILENAME)) as f:
+        index = json.load(f)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+              for name in COMPACT_ARRAYS}
+    return CompactGestures(**index, **arrays)
+
+'''
+  compact_sessions: Yields a (sessionId, userId, values, activity_codes) tuple for
+                    every session in the given CompactGestures. The arrays are
+                    views into the compact arrays, so no data is copied.
+'''
+def compact_sessions(compact):
+    offsets = compact.session_offsets
+    for i, session_id in enumerate(compact.session_ids):
+        start, end = offsets[i], offsets[i + 1]
+        yield (session_id, compact.user_ids[compact.user_codes[i]],
+               compact.values[start:end], compact.activity_codes[start:end])
+
+'''
+  sframe_from_compact: Converts a CompactGestures back into a Turi Create SFrame with
+                       the same columns that sframe_from_folder creates.
+'''
+def sframe_from_compact(compact):
+    session_lengths = np.diff(compact.session_offsets)
+    df = pd.DataFrame({
+        'sessionId': np.repeat(np.array(compact.session_ids, dtype=object), session_lengths),
+        'activity': np.asarray(compact.activities)[compact.activity_codes]})
+    for i, feature in enumerate(compact.features):
+        df[feature] = compact.values[:, i].astype(np.float64)
+    df['userId'] = np.repeat(np.array(compact.user_ids, dtype=object)[compact.user_codes],
+                             session_lengths)
+    return tc.SFrame(df)
+
 '''
   plot_gesture_activity: Uses matplotlib to display a line graph of the data in
                          the given Turi Create SFrame. Can optionally specify a 
                          user ID, activity, and/or list of features to limit what
-                         data gets included in the graph.
+                         data gets included in the graph. These filters are
+                         applied to the SFrame, so only the rows and columns that
+                         get plotted are converted to Pandas. For long recordings,
+                         set max_points to draw at most that many points per
+                         feature, keeping the minimum and maximum of each span of
+                         samples so peaks still show up.
 '''
-def plot_gesture_activity(sframe, userId=None, activity=None, features=None):
-    # Convert to a Pandas DataFrame because it's easy to work with
-    df = sframe.to_dataframe()
-    
+def plot_gesture_activity(sframe, userId=None, activity=None, features=None, max_points=None):
     if activity != None:
-        df = df.loc[df.activity == activity]
+        sframe = sframe[sframe['activity'] == activity]
     else:
         activity = "all"
         
     if userId:
-        df = df.loc[df.userId == userId]
+        sframe = sframe[sframe['userId'] == userId]
         
-    if features:
-        for col in list(df):
-            if col not in features:
-                df = df.drop(columns=[col])
+    # Only numeric columns can be plotted, so don't bother converting the rest.
+    columns = [col for col, col_type in zip(sframe.column_names(), sframe.column_types())
+               if col_type in (int, float) and (not features or col in features)]
+    df = sframe[columns].to_dataframe()
                 
-    if len(df) == 0:
+    if len(df) == 0 or len(columns) == 0:
         print("No data to plot.")
-    else:
+    elif max_points is None or len(df) <= max_points:
         df.plot(kind='line', figsize=(20,10), title='{} samples'.format(activity))
+    else:
+        ax = None
+        for col in columns:
+            series = df[col].iloc[min_max_indices(df[col].values, max_points)]
+            if ax is None:
+                ax = series.plot(kind='line', figsize=(20,10), legend=True,
+                                 title='{} samples'.format(activity))
+            else:
+                series.plot(kind='line', ax=ax, legend=True)
+
+'''
+  min_max_indices: Returns the sorted indices of at most max_points samples from
+                   values, found by splitting values into max_points // 2 equal
+                   spans and keeping the smallest and largest sample of each.
+'''
+def min_max_indices(values, max_points):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) <= max_points:
+        return np.arange(len(values))
+
+    bucket_size = -(-len(values) // max(max_points // 2, 1))
+    num_buckets = -(-len(values) // bucket_size)
+    buckets = np.full(num_buckets * bucket_size, np.nan)
+    buckets[:len(values)] = values
+    buckets = buckets.reshape(num_buckets, bucket_size)
+
+    bucket_starts = np.arange(num_buckets) * bucket_size
+    return np.unique(np.concatenate((bucket_starts + np.nanargmin(buckets, axis=1),
+                                     bucket_starts + np.nanargmax(buckets, axis=1))))
 
 '''
   count_activities: Given a Turi Create SFrame, counts the number of unique sessions
-                    for each activity/user combination. Prints the results.
+                    for each activity/user combination. Prints the results. To
+                    get the counts as a Pandas DataFrame instead, use
+                    SessionStatistics(sframe).activity_user_sessions().
 '''
 def count_activities(sframe):
-    counts = sframe.groupby(
-        ['sessionId', 'activity', 'userId'], [tc.aggregate.COUNT]).groupby(
-        ["activity", "userId"], [tc.aggregate.COUNT])
-    print(counts.sort(['activity', 'userId']))                
-    
+    print(SessionStatistics(sframe, features=[]).activity_user_sessions())
+
+'''
+  SessionStatistics: Collects statistics about a gesture dataset in a single pass
+                     over its rows. Give it an SFrame or Pandas DataFrame with
+                     the columns made by sframe_from_folder, either when creating
+                     it or through update(). update() can be called again
+                     whenever new data arrives, for example with the result of
+                     dataframe_from_csv for each newly recorded file, without
+                     looking at the earlier data again. Rows are grouped by
+                     sessionId, activity and userId, and for each group only the
+                     row count and the mean and sum of squared deviations of each
+                     feature are kept, so memory grows with the number of
+                     sessions rather than the number of rows.
+'''
+class SessionStatistics(object):
+    GROUP_COLUMNS = ['sessionId', 'activity', 'userId']
+
+    def __init__(self, data=None, features=None, samples_per_second=SAMPLES_PER_SECOND):
+        self.features = list(SENSOR_COLUMNS if features is None else features)
+        self.samples_per_second = samples_per_second
+        self.rows = None
+        self.means = None
+        self.m2 = None
+        if data is not None:
+            self.update(data)
+
+    '''
+    Adds the rows of data, which may be an SFrame or a Pandas DataFrame, to the
+    statistics. Returns self to allow for chaining function calls.
+    '''
+    def update(self, data):
+        if hasattr(data, 'to_dataframe'):
+            data = data[self.GROUP_COLUMNS + self.features].to_dataframe()
+        if len(data) == 0:
+            return self
+
+        groups = data.groupby(self.GROUP_COLUMNS, sort=False)[self.features]
+        rows = groups.size()
+        means = groups.mean()
+        m2 = groups.var(ddof=0).mul(rows, axis=0)
+
+        if self.rows is None:
+            self.rows, self.means, self.m2 = rows, means, m2
+        else:
+            self.rows, self.means, self.m2 = merge_moments(
+                self.rows, self.means, self.m2, rows, means, m2)
+        return self
+
+    '''
+    Returns a DataFrame with the number of sessions that contain each
+    activity, for every user, in a column named "Count".
+    '''
+    def activity_user_sessions(self):
+        counts = self.rows.groupby(level=['activity', 'userId']).size()
+        counts = counts.rename('Count').reset_index()
+        return counts.sort_values(['activity', 'userId']).reset_index(drop=True)
+
+    '''
+    Returns a DataFrame with the number of rows and the duration in seconds
+    of every session.
+    '''
+    def session_summary(self):
+        summary = self.rows.groupby(level=['sessionId', 'userId']).sum()
+        summary = summary.rename('rows').reset_index()
+        summary['duration'] = summary['rows'] / self.samples_per_second
+        return summary
+
+    '''
+    Returns a DataFrame with the number of rows and the mean and variance of
+    every feature, in columns named like "rotX_mean" and "rotX_var", for each
+    value of the by column(s). by may be any of the GROUP_COLUMNS or a list
+    of them.
+    '''
+    def channel_statistics(self, by='activity'):
+        rows, means, m2 = combine_moments(self.rows, self.means, self.m2, by)
+        table = means.add_suffix('_mean').join(m2.div(rows, axis=0).add_suffix('_var'))
+        table.insert(0, 'rows', rows)
+        return table.reset_index()
+
+'''
+  merge_moments: Helper function for SessionStatistics that combines the row counts,
+                 means and sums of squared deviations (m2) of two sets of groups.
+                 Groups found in both sets are merged with the parallel variance
+                 formula of Chan et al.
+'''
+def merge_moments(rows_a, means_a, m2_a, rows_b, means_b, m2_b):
+    index = rows_a.index.union(rows_b.index)
+    rows_a = rows_a.reindex(index, fill_value=0)
+    rows_b = rows_b.reindex(index, fill_value=0)
+    means_a = means_a.reindex(index, fill_value=0.0)
+    means_b = means_b.reindex(index, fill_value=0.0)
+
+    rows = rows_a + rows_b
+    delta = means_b - means_a
+    means = means_a + delta.mul(rows_b / rows, axis=0)
+    m2 = m2_a.reindex(index, fill_value=0.0) + m2_b.reindex(index, fill_value=0.0) + \
+         (delta ** 2).mul(rows_a * rows_b / rows, axis=0)
+    return rows, means, m2
+
+'''
+  combine_moments: Helper function for SessionStatistics that combines the row counts,
+                   means and sums of squared deviations (m2) of all groups that
+                   share the same value(s) in the index level(s) named by.
+'''
+def combine_moments(rows, means, m2, by):
+    by = [by] if isinstance(by, str) else list(by)
+    total_rows = rows.groupby(level=by).sum()
+    total_means = means.mul(rows, axis=0).groupby(level=by).sum().div(total_rows, axis=0)
+
+    # Each group's distance from the combined mean adds to the combined m2.
+    other_levels = [name for name in rows.index.names if name not in by]
+    group_keys = rows.index.droplevel(other_levels) if other_levels else rows.index
+    offsets = means - total_means.reindex(group_keys).values
+    total_m2 = (m2 + (offsets ** 2).mul(rows, axis=0)).groupby(level=by).sum()
+    return total_rows, total_means, total_m2
+
 '''
   append_uid_column: Helper function that takes a Turi Create SFrame and a path
                      to the data file used to make the SFrame. Adds a new column
@@ -109,10 +629,19 @@ def count_activities(sframe):
                      to allow for chaining function calls.
 '''
 def append_uid_column(sframe, from_path):
-    filename = Path(from_path).name
-    first_dash = filename.find('-')
-    if first_dash > 0:
-        uid = filename[:first_dash]
+    uid = uid_from_path(from_path)
+    if uid is not None:
         sframe['userId'] = uid
     return sframe
 
+'''
+  uid_from_path: Returns the user ID for the given data file, which is the prefix
+                 of the filename up to the first dash '-', or None if the
+                 filename does not contain a dash.
+'''
+def uid_from_path(from_path):
+    filename = Path(from_path).name
+    first_dash = filename.find('-')
+    if first_dash > 0:
+        return filename[:first_dash]
+    return None
@@ -1,6 +1,10 @@
 import keras
+import numpy as np
 import random
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
+from functools import partial
+from queue import Full, Queue
 from keras.utils import Sequence
 
 """
@@ -9,7 +13,9 @@ properties:
   1. Derived from the samples object passed to init.
   2. Grouped so input sequences are similar in length.
   3. Characters in sequences are one-hot encoded and padded with zeros
-  using batch_encoder passed to init.
+  using batch_encoder passed to init. If batch_encoder returns a fourth
+  value, such as the mask from BatchEncoder's "sparse_targets" and "indices"
+  formats, it is passed to Keras as the batch's sample weights.
   4. Each batch will have no more than batch_size items, but may have
   fewer if there are not enough sequences of similar length.
   5. Sequences are considered similar in length if they require no more
@@ -18,41 +24,76 @@ properties:
   For example:
     If bin_size is 10, all sequences of length <= 10 will appear in batches together,
     sequences of length 11-20 will be together, then 21-30, etc.    
+  6. If shuffle is True, the samples within each bin are reordered after every
+  epoch using a permutation derived from seed and the epoch number, so the
+  batches are reproducible and identical in every worker process.
+  
+  Two options trade the fixed bins and batch size for better throughput:
+    num_bins: Instead of bins bin_size wide, choose num_bins bins from the
+    histogram of input lengths so that the total padding is as small as
+    possible. The chosen upper length of each bin is in bin_boundaries.
+    max_tokens: Fill each batch with as many sequences as fit in a budget of
+    max_tokens padded time steps, counting both the encoder and decoder
+    sequences, instead of a fixed batch_size. Short sequences then get large
+    batches and long ones small batches. batch_size may be None in this mode,
+    otherwise it still caps the number of sequences in a batch.
+  The fraction of padding time steps in each finished epoch is appended to
+  padding_ratios, and printed if verbose is True.
 """
 class Seq2SeqBatchGenerator(Sequence):
     """
     
     """
-    def __init__(self, samples, batch_size, batch_encoder, bin_size=5):
+    def __init__(self, samples, batch_size, batch_encoder, bin_size=5,
+                 shuffle=True, seed=None, max_tokens=None, num_bins=None, verbose=False):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("batch_size may only be None when max_tokens is given")
         self.bin_size = bin_size
         self.batch_size = batch_size
         self.batch_encoder = batch_encoder
+        self.shuffle = shuffle
+        self.seed = seed if seed is not None else random.randrange(2**31)
+        self.max_tokens = max_tokens
+        self.verbose = verbose
+        self.padding_ratios = []
+
+        self.bin_boundaries = None
+        if num_bins is not None:
+            self.bin_boundaries = optimal_bin_boundaries(
+                [len(sample[0]) for sample in samples], num_bins)
         
         # arrange samples in bins grouped by similar sequence sizes
         binned_samples = defaultdict(list)
         for sample in samples:
-            bin_id = (len(sample[0]) - 1) // bin_size
+            if self.bin_boundaries is None:
+                bin_id = (len(sample[0]) - 1) // bin_size
+            else:
+                bin_id = int(np.searchsorted(self.bin_boundaries, len(sample[0])))
             binned_samples[bin_id].append(sample)
         self.binned_samples = binned_samples
-
-        # count how many batches in each bin
-        batches_per_bin = {
-            bin_id : (len(bin_samples) // batch_size + 
-                      (1 if len(bin_samples) % batch_size != 0 else 0))
-            for bin_id, bin_samples in binned_samples.items()}
-        self.num_batches = sum(batches_per_bin.values())
         
         self.available_bins = sorted(self.binned_samples.keys())
-        
-        # Bookkeeping to help figure out which batches go in which bins
-        self.bin_batch_cutoff = {}
-        self.batch_offsets = {}
-        bin_offset = 0
+        self.in_lengths = {b: np.array([len(sample[0]) for sample in bin_samples])
+                           for b, bin_samples in binned_samples.items()}
+        self.out_lengths = {b: np.array([len(sample[1]) for sample in bin_samples])
+                            for b, bin_samples in binned_samples.items()}
+
+        # Lookup table with the bin of every batch and the range of positions
+        # within that bin that it covers, so __getitem__ needs no searching.
+        batch_bin_ids, batch_starts, batch_ends = [], [], []
         for b in self.available_bins:
-            num_batches = batches_per_bin[b]
-            self.batch_offsets[b] = bin_offset
-            bin_offset += num_batches
-            self.bin_batch_cutoff[b] = bin_offset
+            bin_len = len(binned_samples[b])
+            bin_batch_size = self.bin_batch_size(b)
+            starts = list(range(0, bin_len, bin_batch_size))
+            batch_bin_ids += [b] * len(starts)
+            batch_starts += starts
+            batch_ends += [min(start + bin_batch_size, bin_len) for start in starts]
+        self.batch_bin_ids = np.array(batch_bin_ids)
+        self.batch_starts = np.array(batch_starts)
+        self.batch_ends = np.array(batch_ends)
+        self.num_batches = len(batch_bin_ids)
+
+        self.set_epoch(0)
                     
     """
     Required function for all subclasses of Sequence. This returns the total
@@ -61,6 +102,39 @@ class Seq2SeqBatchGenerator(Sequence):
     """
     def __len__(self):
         return self.num_batches
+
+    """
+    Returns the number of sequences in each batch made from the given bin. In
+    max_tokens mode, every sequence is counted as if it were as long as the
+    longest input and output sequences in the bin, so a batch stays within
+    budget whatever order the samples are shuffled into.
+    """
+    def bin_batch_size(self, bin_id):
+        if self.max_tokens is None:
+            return self.batch_size
+        steps_per_sample = self.in_lengths[bin_id].max() + self.out_lengths[bin_id].max()
+        bin_batch_size = max(self.max_tokens // steps_per_sample, 1)
+        if self.batch_size is not None:
+            bin_batch_size = min(bin_batch_size, self.batch_size)
+        return int(bin_batch_size)
+
+    """
+    Returns the fraction of the encoder and decoder time steps in the current
+    epoch's batches that are padding. This only depends on the epoch's
+    sample order, so no batches need to be encoded to compute it.
+    """
+    def padding_ratio(self):
+        real_steps = 0
+        padded_steps = 0
+        for b in self.available_bins:
+            in_bin = self.batch_bin_ids == b
+            starts = self.batch_starts[in_bin]
+            sizes = self.batch_ends[in_bin] - starts
+            order = self.sample_orders[b]
+            for lengths in (self.in_lengths[b][order], self.out_lengths[b][order]):
+                real_steps += lengths.sum()
+                padded_steps += (np.maximum.reduceat(lengths, starts) * sizes).sum()
+        return 1 - real_steps / padded_steps if padded_steps > 0 else 0.0
     
     """
     Option function for subclasses of Sequence. Called after each epoch, this
@@ -68,8 +142,27 @@ class Seq2SeqBatchGenerator(Sequence):
     epoch to epoch. This improves the performance of the optimization algorithm.
     """
     def on_epoch_end(self):
-        for bin_id in self.binned_samples.values():
-            random.shuffle(bin_id)
+        self.padding_ratios.append(self.padding_ratio())
+        if self.verbose:
+            print("Epoch %d padding ratio: %.1f%%" % (self.epoch + 1, 100 * self.padding_ratios[-1]))
+        self.set_epoch(self.epoch + 1)
+
+    """
+    Selects the order in which samples appear in each bin for the given epoch.
+    The samples themselves are never moved. Instead every bin gets a
+    permutation that depends only on seed, epoch and bin, so any copy of this
+    generator, such as one in a Keras worker process, produces exactly the
+    same batches for the same epoch. Epoch 0 uses the original order.
+    """
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.sample_orders = {}
+        for bin_id, bin_samples in self.binned_samples.items():
+            if self.shuffle and epoch > 0:
+                rng = np.random.RandomState([self.seed, epoch, bin_id])
+                self.sample_orders[bin_id] = rng.permutation(len(bin_samples))
+            else:
+                self.sample_orders[bin_id] = np.arange(len(bin_samples))
         
     """
     Required function for all subclasses of Sequence. This returns the batch
@@ -77,34 +170,568 @@ class Seq2SeqBatchGenerator(Sequence):
     even be called from multiple processes.
     """
     def __getitem__(self, idx):
-        # find proper bin for batch
-        for bin_id in self.available_bins: 
-            cutoff_id = self.bin_batch_cutoff[bin_id]
-            if idx < cutoff_id:
-                break
-
-        # find location of batch within bin
-        idx -= self.batch_offsets[bin_id]
-        
         # grab samples for batch and encode them
+        bin_id = self.batch_bin_ids[idx]
         sample_bin = self.binned_samples[bin_id]
-        batch_samples = sample_bin[idx * self.batch_size : (idx+1) * self.batch_size]        
-        enc_in, dec_in, dec_out = self.batch_encoder(batch_samples)
+        order = self.sample_orders[bin_id][self.batch_starts[idx]:self.batch_ends[idx]]
+        batch_samples = [sample_bin[i] for i in order]
+        encoded = self.batch_encoder(batch_samples)
+        enc_in, dec_in, dec_out = encoded[:3]
         
+        if len(encoded) > 3:
+            return [enc_in, dec_in], dec_out, encoded[3]
         return [enc_in, dec_in], dec_out
     
-    
-def test_predictions(samples, encoder, decoder, batch_encoder, sequence_decoder):
+
+def optimal_bin_boundaries(lengths, num_bins):
+    """
+    Splits the histogram of the given sequence lengths into at most num_bins
+    bins so that padding every sequence to the longest length in its bin
+    adds as few padding steps as possible. Returns the sorted list of the
+    largest length in each bin. Uses dynamic programming over the distinct
+    lengths, which is fast because there are only as many as the longest
+    sequence.
+    """
+    values, counts = np.unique(lengths, return_counts=True)
+    num_values = len(values)
+    num_bins = max(min(num_bins, num_values), 1)
+    cum_counts = np.concatenate(([0], np.cumsum(counts)))
+    cum_steps = np.concatenate(([0], np.cumsum(values * counts)))
+
+    def padding(first, last):
+        # Padding needed when values[first..last] all go into the same bin.
+        return (values[last] * (cum_counts[last + 1] - cum_counts[first]) -
+                (cum_steps[last + 1] - cum_steps[first]))
+
+    # best[b, j] is the least padding for values[0..j] split into b+1 bins,
+    # and first_value[b, j] is where the last of those bins starts.
+    best = np.full((num_bins, num_values), np.inf)
+    first_value = np.zeros((num_bins, num_values), dtype=int)
+    for j in range(num_values):
+        best[0, j] = padding(0, j)
+    for b in range(1, num_bins):
+        for j in range(b, num_values):
+            for i in range(b, j + 1):
+                cost = best[b - 1, i - 1] + padding(i, j)
+                if cost < best[b, j]:
+                    best[b, j] = cost
+                    first_value[b, j] = i
+
+    boundaries = [values[-1]]
+    last = num_values - 1
+    for b in range(num_bins - 1, 0, -1):
+        last = first_value[b, last] - 1
+        boundaries.append(values[last])
+    return [int(length) for length in reversed(boundaries)]
+
+
+def prefetch_batches(sequence, queue_size=4, epochs=None):
+    """
+    Python generator that yields the batches of sequence, such as a
+    Seq2SeqBatchGenerator, in order while a background thread keeps up to
+    queue_size encoded batches ready. Calls sequence.on_epoch_end() after
+    every epoch and stops after the given number of epochs, or never if
+    epochs is None. Pass it to fit_generator with steps_per_epoch set to
+    len(sequence).
+    """
+    batches = Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    class Failed(object):
+        def __init__(self, error):
+            self.error = error
+
+    def put(item):
+        # Waits for room in the queue, but gives up once the consumer has
+        # stopped, so the thread doesn't block forever on a full queue.
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            epoch = 0
+            while epochs is None or epoch < epochs:
+                for idx in range(len(sequence)):
+                    if not put(sequence[idx]):
+                        return
+                sequence.on_epoch_end()
+                epoch += 1
+            put(done)
+        except Exception as error:
+            put(Failed(error))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is done:
+                return
+            if isinstance(batch, Failed):
+                raise batch.error
+            yield batch
+    finally:
+        stop.set()
+
+
+class BatchEncoder(object):
+    """
+    Vectorized replacement for the notebooks' encode_batch function, to pass
+    as the batch_encoder of a Seq2SeqBatchGenerator. Each sample is converted
+    to arrays of token indices the first time it is seen, and the padded batch
+    tensors are then built with NumPy fancy indexing rather than one item
+    assignment per character.
+
+    output_format chooses what the encoder returns:
+      "one_hot": the same three float32 tensors as encode_batch, each of
+        shape (batch_size, seq_len, vocab_size).
+      "sparse_targets": the same one-hot encoder and decoder inputs, but the
+        decoder output is an int32 tensor of shape (batch_size, seq_len, 1)
+        holding token indices, followed by a float32 (batch_size, seq_len)
+        mask that is 1 for real time steps and 0 for padding. Use it with
+        the sparse_categorical_crossentropy loss and
+        sample_weight_mode="temporal" to skip one of the one-hot tensors.
+      "indices": like "sparse_targets", but the encoder and decoder inputs
+        are int32 tensors of shape (batch_size, seq_len) holding each
+        token's index plus one, with zeros for padding, to feed an Embedding
+        layer created with mask_zero=True. No tensor in the batch has a
+        vocab_size dimension.
+
+    By default every distinct sample stays tokenized for the lifetime of the
+    encoder, which suits a fixed training set. Give token_cache_size to keep
+    only that many recently used samples instead, as a server should.
+    """
+    OUTPUT_FORMATS = ("one_hot", "sparse_targets", "indices")
+
+    def __init__(self, in_token2int, out_token2int, output_format="one_hot",
+                 token_cache_size=None):
+        if output_format not in self.OUTPUT_FORMATS:
+            raise ValueError("output_format must be one of " + ", ".join(self.OUTPUT_FORMATS))
+        self.in_token2int = in_token2int
+        self.out_token2int = out_token2int
+        self.output_format = output_format
+        self.in_one_hot_table = make_one_hot_table(len(in_token2int))
+        self.out_one_hot_table = make_one_hot_table(len(out_token2int))
+        self.token_cache = LRUCache(token_cache_size) if token_cache_size is not None else {}
+
+    def tokenize(self, sample):
+        """
+        Returns the input and output sequences of sample as int32 arrays of
+        token indices, converting them only the first time sample is seen.
+        """
+        key = tuple(sample)
+        tokens = self.token_cache.get(key)
+        if tokens is None:
+            in_seq, out_seq = sample
+            tokens = (np.array([self.in_token2int[t] for t in in_seq], dtype=np.int32),
+                      np.array([self.out_token2int[t] for t in out_seq], dtype=np.int32))
+            self.token_cache[key] = tokens
+        return tokens
+
+    def __call__(self, samples):
+        tokens = [self.tokenize(sample) for sample in samples]
+        enc_in_seqs = pad_token_arrays([in_seq for in_seq, _ in tokens])
+        dec_in_seqs = pad_token_arrays([out_seq for _, out_seq in tokens])
+        dec_out_seqs = pad_token_arrays([out_seq[1:] for _, out_seq in tokens],
+                                        dec_in_seqs.shape[1])
+
+        if self.output_format == "one_hot":
+            # Padding is -1, which picks the all-zeros last row of each table.
+            return (self.in_one_hot_table[enc_in_seqs],
+                    self.out_one_hot_table[dec_in_seqs],
+                    self.out_one_hot_table[dec_out_seqs])
+
+        dec_out_mask = (dec_out_seqs >= 0).astype(np.float32)
+        sparse_dec_out_seqs = np.maximum(dec_out_seqs, 0)[:, :, np.newaxis]
+        if self.output_format == "sparse_targets":
+            return (self.in_one_hot_table[enc_in_seqs],
+                    self.out_one_hot_table[dec_in_seqs],
+                    sparse_dec_out_seqs, dec_out_mask)
+        return enc_in_seqs + 1, dec_in_seqs + 1, sparse_dec_out_seqs, dec_out_mask
+
+
+def make_one_hot_table(vocab_size):
+    """
+    Returns a float32 lookup table whose row i is the one-hot encoding of
+    token index i, followed by an extra row of zeros used for padding.
+    """
+    table = np.zeros((vocab_size + 1, vocab_size), dtype=np.float32)
+    table[np.arange(vocab_size), np.arange(vocab_size)] = 1
+    return table
+
+
+def pad_token_arrays(token_arrays, seq_len=None):
+    """
+    Stacks a list of 1-D token index arrays into an int32 array of shape
+    (len(token_arrays), seq_len), padding the end of each row with -1.
+    seq_len defaults to the length of the longest array.
+    """
+    lengths = np.array([len(tokens) for tokens in token_arrays])
+    if seq_len is None:
+        seq_len = lengths.max()
+    padded = np.full((len(token_arrays), seq_len), -1, dtype=np.int32)
+    padded[np.arange(seq_len) < lengths[:, np.newaxis]] = np.concatenate(token_arrays)
+    return padded
+
+
+def test_predictions(samples, encoder, decoder, batch_encoder, sequence_decoder,
+                     verbose=True):
     """
     Helper function to test model. samples should be a list of tuples with 
     Spanish-English sequence pairs. Encoder and decoder should work with 
-    sequence_decoder and sequence encoded by batch_encoder.
+    sequence_decoder and sequence encoded by batch_encoder. Prints every
+    prediction, or with verbose=False returns them instead as a list of
+    (input, dataset translation, model output) tuples. This translates one
+    sample at a time; use Seq2SeqTranslator to translate large numbers of
+    samples.
     """
+    results = []
     for sample in samples:
-        encoded_seq, _, _ = batch_encoder([sample])
+        encoded_seq = batch_encoder([sample])[0]
         decoded_sentence = sequence_decoder(encoded_seq, encoder, decoder)
+        results.append((sample[0], sample[1], decoded_sentence))
+
+        if verbose:
+            print("-----------------------------------------")
+            print("Input sentence:", sample[0])
+            print("Dataset translation:", sample[1])
+            print("Model output:", decoded_sentence)
+    if not verbose:
+        return results
+
+
+class Seq2SeqTranslator(object):
+    """
+    Batched inference for the encoder and decoder models built in the seq2seq
+    notebooks, as a faster alternative to calling translate_sequence for one
+    sample at a time. Works both with LSTM models, whose encoder outputs
+    [h, c] and whose decoder takes [decoder_in, h, c], and with GRU models,
+    whose encoder outputs h and whose decoder takes [decoder_in, h].
+
+    batch_encoder is used to one-hot encode input sequences, and only the
+    first tensor it returns is used. The decoder is fed one-hot encoded
+    tokens, whose indices map to characters through out_int2token. Output
+    sequences end at stop_token_idx or after max_out_seq_len characters.
+    """
+    def __init__(self, encoder, decoder, batch_encoder, out_int2token,
+                 start_token_idx, stop_token_idx, max_out_seq_len):
+        self.encoder = encoder
+        self.decoder = decoder
+        self.batch_encoder = batch_encoder
+        self.out_int2token = out_int2token
+        self.out_vocab_size = len(out_int2token)
+        self.start_token_idx = start_token_idx
+        self.stop_token_idx = stop_token_idx
+        self.max_out_seq_len = max_out_seq_len
+
+    def encode(self, in_seqs):
+        """
+        Runs the encoder on a list of input sequences in one batch and returns
+        the list of decoder states.
+        """
+        enc_in = self.batch_encoder([(in_seq, "") for in_seq in in_seqs])[0]
+        states = self.encoder.predict(enc_in, batch_size=len(in_seqs))
+        return states if isinstance(states, list) else [states]
+
+    def decoder_step(self, tokens, states):
+        """
+        Feeds one token per sequence to the decoder. Returns the probabilities
+        of the next token, with shape (len(tokens), out_vocab_size), and the
+        new decoder states.
+        """
+        dec_in = np.zeros((len(tokens), 1, self.out_vocab_size), dtype=np.float32)
+        dec_in[np.arange(len(tokens)), 0, tokens] = 1
+        outputs = self.decoder.predict([dec_in] + states, batch_size=len(tokens))
+        return outputs[0][:, -1, :], list(outputs[1:])
+
+    def decode_greedy(self, states):
+        """
+        Decodes every sequence in the batch of decoder states in lockstep,
+        choosing the most likely token at each step. Sequences that emit the
+        stop token are dropped from the batch, and decoding ends when none
+        are left. Returns the list of decoded strings.
+        """
+        outputs = [[] for _ in range(len(states[0]))]
+        active = np.arange(len(outputs))
+        tokens = np.full(len(outputs), self.start_token_idx)
+        for _ in range(self.max_out_seq_len):
+            probs, states = self.decoder_step(tokens, states)
+            tokens = np.argmax(probs, axis=-1)
+
+            still_active = tokens != self.stop_token_idx
+            for row in np.flatnonzero(still_active):
+                outputs[active[row]].append(self.out_int2token[int(tokens[row])])
+
+            active = active[still_active]
+            tokens = tokens[still_active]
+            states = [state[still_active] for state in states]
+            if len(active) == 0:
+                break
+        return ["".join(output) for output in outputs]
+
+    def decode_beam(self, states, beam_width=4, length_penalty=0.6, early_stopping=True):
+        """
+        Decodes every sequence in the batch of decoder states with beam search,
+        keeping the beam_width most likely partial translations per sequence.
+        All beams of all sequences go through the decoder together, so each
+        step is a single predict call, and each beam carries its own decoder
+        states. Hypotheses are ranked by their total log probability divided
+        by ((5 + length) / 6) ** length_penalty, so larger length_penalty
+        values favor longer outputs and 0 disables the normalization.
+
+        A sequence is done once it has beam_width finished hypotheses if
+        early_stopping is True, or otherwise once none of its live beams can
+        still beat them. Done sequences are dropped from the batch. Returns
+        the best translation of each sequence as a string.
+        """
+        def normalize(score, length):
+            return score / ((5.0 + length) / 6.0) ** length_penalty
+
+        num_seqs = len(states[0])
+        finished = [[] for _ in range(num_seqs)]
+        active = np.arange(num_seqs)
+
+        # Only the first beam of each sequence starts out alive.
+        scores = np.full((num_seqs, beam_width), -np.inf)
+        scores[:, 0] = 0.0
+        seqs = np.zeros((num_seqs, beam_width, 0), dtype=int)
+        tokens = np.full(num_seqs * beam_width, self.start_token_idx)
+        states = [np.repeat(state, beam_width, axis=0) for state in states]
+
+        for step in range(1, self.max_out_seq_len + 1):
+            probs, states = self.decoder_step(tokens, states)
+            rows = np.arange(len(active))[:, np.newaxis]
+            log_probs = np.log(np.maximum(probs, 1e-30)).reshape(len(active), beam_width, -1)
+            vocab_size = log_probs.shape[-1]
+
+            # Best 2 * beam_width extensions of each sequence's beams, so that
+            # beam_width of them are left even if the rest end in the stop token.
+            candidates = (scores[:, :, np.newaxis] + log_probs).reshape(len(active), -1)
+            num_candidates = min(2 * beam_width, candidates.shape[1])
+            top = np.argpartition(-candidates, num_candidates - 1, axis=1)[:, :num_candidates]
+            top = top[rows, np.argsort(-candidates[rows, top], axis=1)]
+            top_scores = candidates[rows, top]
+            beam_ids = top // vocab_size
+            token_ids = top % vocab_size
+            is_stop = token_ids == self.stop_token_idx
+
+            # Stop tokens among the best beam_width extensions finish a hypothesis.
+            finishing = is_stop & np.isfinite(top_scores)
+            finishing[:, beam_width:] = False
+            for row, col in zip(*np.nonzero(finishing)):
+                finished[active[row]].append(
+                    (normalize(top_scores[row, col], step), seqs[row, beam_ids[row, col]]))
+
+            live = np.argsort(is_stop, axis=1, kind="stable")[:, :beam_width]
+            beam_ids = beam_ids[rows, live]
+            token_ids = token_ids[rows, live]
+            scores = np.where(is_stop[rows, live], -np.inf, top_scores[rows, live])
+            seqs = np.concatenate((seqs[rows, beam_ids], token_ids[:, :, np.newaxis]), axis=2)
+            states = [state[(rows * beam_width + beam_ids).ravel()] for state in states]
+            tokens = token_ids.ravel()
+
+            done = ~np.isfinite(scores).any(axis=1)
+            for row, seq_idx in enumerate(active):
+                hypotheses = finished[seq_idx]
+                if len(hypotheses) >= beam_width:
+                    worst_kept = sorted(h[0] for h in hypotheses)[-beam_width]
+                    best_possible = normalize(scores[row].max(), self.max_out_seq_len)
+                    done[row] |= early_stopping or best_possible <= worst_kept
+            if done.any():
+                keep = ~done
+                active, scores, seqs, tokens = active[keep], scores[keep], seqs[keep], \
+                                               tokens[np.repeat(keep, beam_width)]
+                states = [state[np.repeat(keep, beam_width)] for state in states]
+            if len(active) == 0:
+                break
+
+        # Sequences that reached max_out_seq_len keep their live beams as is.
+        for row, seq_idx in enumerate(active):
+            for beam in np.flatnonzero(np.isfinite(scores[row])):
+                finished[seq_idx].append((normalize(scores[row, beam], seqs.shape[2]),
+                                          seqs[row, beam]))
+
+        return ["".join(self.out_int2token[int(t)] for t in max(h, key=lambda h: h[0])[1])
+                if h else "" for h in finished]
+
+    def translate_beam(self, in_seqs, batch_size=16, beam_width=4, length_penalty=0.6,
+                       early_stopping=True):
+        """
+        Like translate, but decodes with decode_beam. Each decoder call
+        processes batch_size * beam_width beams.
+        """
+        decode = partial(self.decode_beam, beam_width=beam_width,
+                         length_penalty=length_penalty, early_stopping=early_stopping)
+        return self.translate(in_seqs, batch_size, decode)
+
+    def translate(self, in_seqs, batch_size=64, decode=None):
+        """
+        Translates a list of input sequences and returns the list of output
+        strings in the same order. Inputs are sorted by length and processed
+        batch_size at a time to keep padding low. decode is the method that
+        turns a batch of decoder states into strings, decode_greedy if None.
+        """
+        decode = decode or self.decode_greedy
+        order = sorted(range(len(in_seqs)), key=lambda i: len(in_seqs[i]))
+        results = [None] * len(in_seqs)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            states = self.encode([in_seqs[i] for i in batch])
+            for i, output in zip(batch, decode(states)):
+                results[i] = output
+        return results
+
+    def test_predictions(self, samples, batch_size=64):
+        """
+        Batched version of the test_predictions function. Returns a list of
+        (input, dataset translation, model output) tuples without printing.
+        """
+        outputs = self.translate([sample[0] for sample in samples], batch_size)
+        return [(sample[0], sample[1], output) for sample, output in zip(samples, outputs)]
+
+
+class LRUCache(object):
+    """
+    Dictionary-like cache that holds at most max_size items and evicts the
+    least recently used one when full. Counts hits, misses and evictions.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    __setitem__ = put
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        return {"size": len(self.items), "max_size": self.max_size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+class CachingTranslator(object):
+    """
+    Front-end for a Seq2SeqTranslator that remembers the translations of the
+    last max_size distinct inputs, so inputs that repeat skip the model
+    entirely. Inputs are looked up after passing through normalize, which by
+    default trims them and collapses runs of whitespace. Greedy and beam
+    search results, and beam searches with different settings, are cached
+    separately.
+
+    If encoder_cache_size is given, the encoder states of that many recent
+    inputs are cached as well, so translating an input again with different
+    decoding settings only runs the decoder. The encoder models only return
+    their final states, so states are reused for identical inputs rather
+    than shared prefixes.
+    """
+    def __init__(self, translator, max_size=10000, encoder_cache_size=None, normalize=None):
+        self.translator = translator
+        self.cache = LRUCache(max_size)
+        self.encoder_cache = LRUCache(encoder_cache_size) if encoder_cache_size else None
+        self.normalize = normalize or (lambda in_seq: " ".join(in_seq.split()))
+
+    def translate(self, in_seqs, batch_size=64):
+        """
+        Cached version of Seq2SeqTranslator.translate.
+        """
+        return self.cached_translate(in_seqs, ("greedy",), batch_size,
+                                     self.translator.decode_greedy)
+
+    def translate_beam(self, in_seqs, batch_size=16, beam_width=4, length_penalty=0.6,
+                       early_stopping=True):
+        """
+        Cached version of Seq2SeqTranslator.translate_beam.
+        """
+        decode = partial(self.translator.decode_beam, beam_width=beam_width,
+                         length_penalty=length_penalty, early_stopping=early_stopping)
+        return self.cached_translate(
+            in_seqs, ("beam", beam_width, length_penalty, early_stopping), batch_size, decode)
+
+    def cached_translate(self, in_seqs, mode, batch_size, decode):
+        """
+        Returns the translation of every input, looking each one up under
+        the key (mode, normalized input) and translating all distinct misses
+        together in batches with decode.
+        """
+        keys = [self.normalize(in_seq) for in_seq in in_seqs]
+        results = {}
+        missing = []
+        for key in keys:
+            if key in results:
+                continue
+            result = self.cache.get((mode, key))
+            if result is None:
+                missing.append(key)
+                results[key] = None
+            else:
+                results[key] = result
+
+        if missing:
+            for key, result in zip(missing, self.translate_uncached(missing, batch_size, decode)):
+                self.cache.put((mode, key), result)
+                results[key] = result
+        return [results[key] for key in keys]
+
+    def translate_uncached(self, in_seqs, batch_size, decode):
+        """
+        Translates in_seqs with the model, reusing and filling the encoder
+        state cache when there is one.
+        """
+        if self.encoder_cache is None:
+            return self.translator.translate(in_seqs, batch_size, decode)
+
+        order = sorted(range(len(in_seqs)), key=lambda i: len(in_seqs[i]))
+        results = [None] * len(in_seqs)
+        for start in range(0, len(order), batch_size):
+            batch = [in_seqs[i] for i in order[start:start + batch_size]]
+            batch_states = [self.encoder_cache.get(in_seq) for in_seq in batch]
+            to_encode = [in_seq for in_seq, states in zip(batch, batch_states) if states is None]
+            if to_encode:
+                encoded = iter(zip(*self.translator.encode(to_encode)))
+                for j, in_seq in enumerate(batch):
+                    if batch_states[j] is None:
+                        batch_states[j] = next(encoded)
+                        self.encoder_cache.put(in_seq, batch_states[j])
+            states = [np.stack(state) for state in zip(*batch_states)]
+            for i, output in zip(order[start:start + batch_size], decode(states)):
+                results[i] = output
+        return results
 
-        print("-----------------------------------------")
-        print("Input sentence:", sample[0])
-        print("Dataset translation:", sample[1])
-        print("Model output:", decoded_sentence)
\ No newline at end of file
+    def stats(self):
+        """
+        Returns the counters of the translation cache and, if enabled, the
+        encoder state cache.
+        """
+        stats = {"translations": self.cache.stats()}
+        if self.encoder_cache is not None:
+            stats["encoder_states"] = self.encoder_cache.stats()
+        return stats
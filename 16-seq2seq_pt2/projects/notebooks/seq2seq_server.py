@@ -0,0 +1,320 @@
+"""
+Serves a trained seq2seq translator over HTTP or stdin, grouping requests
+that arrive close together into micro-batches so each encoder and decoder
+call translates many inputs at once.
+
+Save the inference models from the notebook with inf_encoder.save(...) and
+inf_decoder.save(...), along with the esCharToInt.json and intToEnChar.json
+files the notebook exports, then run for example:
+
+    python seq2seq_server.py --encoder encoder.h5 --decoder decoder.h5 \
+        --in-vocab esCharToInt.json --out-vocab intToEnChar.json --port 8000
+
+and POST {"inputs": ["¿Cómo estás?"]} to /translate, or GET /metrics.
+Without --port, input sequences are read from stdin, one per line, and
+translations are printed in the same order.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class MicroBatcher(object):
+    """
+    Collects concurrent translate() calls and runs them through translator
+    together. A batch is sent as soon as it holds max_batch_size inputs, or
+    max_wait_ms after its first input arrived. translator is anything with a
+    translate(list_of_inputs) method, such as a Seq2SeqTranslator or a
+    CachingTranslator. It runs on executor, a single background thread by
+    default, so the event loop keeps accepting requests meanwhile.
+    """
+    def __init__(self, translator, max_batch_size=32, max_wait_ms=5,
+                 executor=None, latency_window=10000):
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.latencies = deque(maxlen=latency_window)
+        self.completed = 0
+        self.batches = 0
+        self.start_time = time.time()
+
+    async def translate(self, in_seq):
+        """
+        Queues in_seq for the next batch and returns its translation.
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((in_seq, future, time.time()))
+        return await future
+
+    async def run(self):
+        """
+        Forms and translates batches until cancelled.
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self.translate_batch(batch)
+            self.completed += len(batch)
+            self.batches += 1
+
+    async def translate_batch(self, batch):
+        """
+        Translates a batch of (in_seq, future, start_time) and resolves the
+        futures. If the batch fails, its inputs are retried one at a time, so
+        only the futures of the inputs that fail on their own get the error.
+        """
+        loop = asyncio.get_running_loop()
+        in_seqs = [in_seq for in_seq, _, _ in batch]
+        try:
+            outputs = await loop.run_in_executor(
+                self.executor, self.translator.translate, in_seqs)
+        except Exception as error:
+            if len(batch) > 1:
+                for item in batch:
+                    await self.translate_batch([item])
+                return
+            _, future, start_time = batch[0]
+            if not future.done():
+                future.set_exception(error)
+            self.latencies.append(time.time() - start_time)
+            return
+
+        finish_time = time.time()
+        for (_, future, start_time), output in zip(batch, outputs):
+            if not future.done():
+                future.set_result(output)
+            self.latencies.append(finish_time - start_time)
+
+    def metrics(self):
+        """
+        Returns the p50 and p99 latency in milliseconds over the most recent
+        requests, plus overall throughput and average batch size.
+        """
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "completed": self.completed,
+            "batches": self.batches,
+            "mean_batch_size": self.completed / self.batches if self.batches else 0.0,
+            "throughput_per_sec": self.completed / elapsed,
+            "p50_latency_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_latency_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+
+async def handle_http(batcher, reader, writer):
+    """
+    Handles one HTTP/1.1 request: POST /translate with a JSON body of
+    {"inputs": [...]} or {"input": "..."}, or GET /metrics.
+    """
+    try:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            method, path = request_line[:2] if len(request_line) >= 2 else ("", "")
+            if method == "GET" and path == "/metrics":
+                status, payload = "200 OK", batcher.metrics()
+            elif method == "POST" and path == "/translate":
+                in_seqs, single = parse_translate_request(body)
+                try:
+                    outputs = await asyncio.gather(*(batcher.translate(in_seq)
+                                                     for in_seq in in_seqs))
+                except Exception as error:
+                    status, payload = "500 Internal Server Error", {"error": repr(error)}
+                else:
+                    if single:
+                        status, payload = "200 OK", {"output": outputs[0]}
+                    else:
+                        status, payload = "200 OK", {"outputs": list(outputs)}
+            else:
+                status, payload = "404 Not Found", {"error": "unknown endpoint"}
+        except (ValueError, asyncio.IncompleteReadError) as error:
+            status, payload = "400 Bad Request", {"error": str(error)}
+
+        response = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json; charset=utf-8\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n"
+                      % (status, len(response))).encode("latin-1") + response)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def parse_translate_request(body):
+    """
+    Returns the input strings of a /translate body and whether it used the
+    single "input" form. Raises ValueError for anything else.
+    """
+    request = json.loads(body.decode("utf-8"))
+    if not isinstance(request, dict):
+        raise ValueError("expected a JSON object")
+    if "inputs" in request:
+        in_seqs, single = request["inputs"], False
+        if not isinstance(in_seqs, list):
+            raise ValueError('"inputs" must be a list of strings')
+    elif "input" in request:
+        in_seqs, single = [request["input"]], True
+    else:
+        raise ValueError('expected "inputs" or "input"')
+    if not all(isinstance(in_seq, str) for in_seq in in_seqs):
+        raise ValueError("inputs must be strings")
+    return in_seqs, single
+
+
+async def serve_http(batcher, host, port):
+    """
+    Serves /translate and /metrics on host:port until interrupted.
+    """
+    batcher_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_http(batcher, reader, writer), host, port)
+    print("Serving on http://%s:%d" % (host, port), file=sys.stderr)
+    try:
+        await server.serve_forever()
+    finally:
+        batcher_task.cancel()
+
+
+async def serve_stdin(batcher):
+    """
+    Translates every line of stdin, printing the results in input order.
+    Lines are submitted as they are read, so they get batched together.
+    """
+    batcher_task = asyncio.ensure_future(batcher.run())
+    loop = asyncio.get_running_loop()
+    pending = deque()
+
+    async def print_ready(wait_for_all):
+        # A line that fails to translate prints as an empty line, so the
+        # output stays aligned with the input.
+        while pending and (wait_for_all or pending[0].done()):
+            try:
+                print(await pending.popleft(), flush=True)
+            except Exception as error:
+                print("Translation failed: %r" % (error,), file=sys.stderr)
+                print(flush=True)
+
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        pending.append(asyncio.ensure_future(batcher.translate(line.rstrip("\n"))))
+        await print_ready(False)
+    await print_ready(True)
+    batcher_task.cancel()
+    print(json.dumps(batcher.metrics()), file=sys.stderr)
+
+
+class FilteringTranslator(object):
+    """
+    Removes tokens that are not in known_tokens from every input before
+    passing it to translator, as the notebooks do for the validation set.
+    """
+    def __init__(self, translator, known_tokens):
+        self.translator = translator
+        self.known_tokens = known_tokens
+
+    def __getattr__(self, name):
+        return getattr(self.translator, name)
+
+    def translate(self, in_seqs, batch_size=64, decode=None):
+        in_seqs = ["".join(t for t in in_seq if t in self.known_tokens) for in_seq in in_seqs]
+        return self.translator.translate(in_seqs, batch_size, decode)
+
+    def encode(self, in_seqs):
+        in_seqs = ["".join(t for t in in_seq if t in self.known_tokens) for in_seq in in_seqs]
+        return self.translator.encode(in_seqs)
+
+
+def load_translator(args):
+    """
+    Loads the models and vocabularies named on the command line. Meant to run
+    on the batcher's executor thread, so the models are built on the same
+    thread that will use them.
+    """
+    from keras.models import load_model
+    from seq2seq_util import BatchEncoder, CachingTranslator, Seq2SeqTranslator
+
+    with open(args.in_vocab, encoding="utf-8") as f:
+        in_token2int = json.load(f)
+    with open(args.out_vocab, encoding="utf-8") as f:
+        out_int2token = {int(i): token for i, token in json.load(f).items()}
+    out_token2int = {token: i for i, token in out_int2token.items()}
+
+    encoder = load_model(args.encoder, compile=False)
+    decoder = load_model(args.decoder, compile=False)
+    encoder._make_predict_function()
+    decoder._make_predict_function()
+
+    # Characters the model never saw can't be encoded, so they are dropped.
+    batch_encoder = BatchEncoder(in_token2int, out_token2int,
+                                 token_cache_size=args.token_cache_size)
+    translator = Seq2SeqTranslator(encoder, decoder, batch_encoder, out_int2token,
+                                   out_token2int["\t"], out_token2int["\n"],
+                                   args.max_out_len)
+    known_tokens = set(in_token2int)
+    filtered = FilteringTranslator(translator, known_tokens)
+    if args.cache_size > 0:
+        return CachingTranslator(filtered, max_size=args.cache_size)
+    return filtered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batching seq2seq translation server.")
+    parser.add_argument("--encoder", required=True, help="saved inference encoder model")
+    parser.add_argument("--decoder", required=True, help="saved inference decoder model")
+    parser.add_argument("--in-vocab", required=True, help="JSON map from input token to index")
+    parser.add_argument("--out-vocab", required=True, help="JSON map from index to output token")
+    parser.add_argument("--max-out-len", type=int, default=100)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="number of translations to cache, 0 to disable")
+    parser.add_argument("--token-cache-size", type=int, default=10000,
+                        help="number of tokenized inputs to keep, 0 to disable")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="serve HTTP on this port instead of stdin")
+    args = parser.parse_args()
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    translator = executor.submit(load_translator, args).result()
+    batcher = MicroBatcher(translator, args.max_batch_size, args.max_wait_ms, executor)
+
+    if args.port is None:
+        asyncio.run(serve_stdin(batcher))
+    else:
+        asyncio.run(serve_http(batcher, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()